@@ -1,23 +1,40 @@
 import os
 import uuid
+import time
+import atexit
+import logging
+import threading
 import psycopg2
 from psycopg2 import sql
+from psycopg2.extras import execute_values
 from datetime import datetime
 from contextlib import contextmanager
 
+logger = logging.getLogger("Database")
+
 # Конфигурация PostgreSQL
 POSTGRES_HOST = os.getenv("POSTGRES_HOST", "postgres")
 POSTGRES_DB = os.getenv("POSTGRES_DB", "ragdb")
 POSTGRES_USER = os.getenv("POSTGRES_USER", "raguser")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "ragpassword")
 
+# Отложенная (write-behind) запись сообщений чата. Чтение собственных записей
+# гарантируется в пределах процесса, который принял сообщение
+MESSAGE_WRITE_BEHIND = os.getenv("MESSAGE_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", "0.5"))
+MESSAGE_FLUSH_BATCH = int(os.getenv("MESSAGE_FLUSH_BATCH", "500"))
+MESSAGE_SHUTDOWN_RETRIES = int(os.getenv("MESSAGE_SHUTDOWN_RETRIES", "5"))
+
 @contextmanager
 def get_db_connection():
+    # Все временные метки хранятся в UTC: CURRENT_TIMESTAMP в сессии совпадает
+    # с datetime.utcnow(), которым помечаются буферизованные сообщения и границы секций
     conn = psycopg2.connect(
         host=POSTGRES_HOST,
         database=POSTGRES_DB,
         user=POSTGRES_USER,
-        password=POSTGRES_PASSWORD
+        password=POSTGRES_PASSWORD,
+        options="-c timezone=UTC"
     )
     try:
         yield conn
@@ -34,6 +51,16 @@ def get_db_cursor():
         finally:
             cursor.close()
 
+# Таблицы, секционированные по месяцам: имя таблицы -> колонка секционирования
+PARTITIONED_TABLES = {
+    "messages": "timestamp",
+    "async_tasks": "created_at",
+}
+PARTITION_PREMAKE_MONTHS = int(os.getenv("PARTITION_PREMAKE_MONTHS", "2"))
+
+# Версия схемы, которую создает create_tables; увеличивается при каждом изменении DDL
+SCHEMA_VERSION = 2
+
 def create_tables():
     with get_db_cursor() as cursor:
         cursor.execute("""
@@ -48,14 +75,15 @@ def create_tables():
         
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS messages (
-                message_id SERIAL PRIMARY KEY,
+                message_id BIGSERIAL,
                 session_id UUID REFERENCES sessions(session_id) ON DELETE CASCADE,
                 timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
                 role VARCHAR(10) NOT NULL CHECK (role IN ('user', 'assistant')),
                 content TEXT NOT NULL,
                 context TEXT,
-                sources TEXT
-            );
+                sources TEXT,
+                PRIMARY KEY (message_id, timestamp)
+            ) PARTITION BY RANGE (timestamp);
         """)
         
         cursor.execute("""
@@ -68,6 +96,153 @@ def create_tables():
             );
         """)
 
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS async_tasks (
+                task_id UUID NOT NULL,
+                session_id UUID REFERENCES sessions(session_id) ON DELETE SET NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                started_at TIMESTAMP,
+                completed_at TIMESTAMP,
+                status VARCHAR(20) NOT NULL CHECK (status IN ('pending', 'processing', 'completed', 'failed')) DEFAULT 'pending',
+                username VARCHAR(255),
+                user_id VARCHAR(255),
+                question TEXT NOT NULL,
+                answer TEXT,
+                error TEXT,
+                batch_id UUID,
+                batch_index INTEGER,
+                query_embedding REAL[],
+                worker_id TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                heartbeat_at TIMESTAMP,
+                lease_expires_at TIMESTAMP,
+                tenant VARCHAR(64),
+                PRIMARY KEY (task_id, created_at)
+            ) PARTITION BY RANGE (created_at);
+        """)
+        cursor.execute("ALTER TABLE async_tasks ADD COLUMN IF NOT EXISTS batch_id UUID")
+        cursor.execute("ALTER TABLE async_tasks ADD COLUMN IF NOT EXISTS batch_index INTEGER")
+        cursor.execute("ALTER TABLE async_tasks ADD COLUMN IF NOT EXISTS query_embedding REAL[]")
+        cursor.execute("ALTER TABLE async_tasks ADD COLUMN IF NOT EXISTS worker_id TEXT")
+        cursor.execute("ALTER TABLE async_tasks ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0")
+        cursor.execute("ALTER TABLE async_tasks ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP")
+        cursor.execute("ALTER TABLE async_tasks ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP")
+        cursor.execute("ALTER TABLE async_tasks ADD COLUMN IF NOT EXISTS tenant VARCHAR(64)")
+
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_last_activity ON sessions(last_activity)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, timestamp)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_async_tasks_user ON async_tasks(user_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_async_tasks_session ON async_tasks(session_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_async_tasks_status ON async_tasks(status)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_async_tasks_created ON async_tasks(created_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_async_tasks_batch ON async_tasks(batch_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_async_tasks_pending ON async_tasks(created_at) WHERE status = 'pending'")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_async_tasks_lease ON async_tasks(lease_expires_at) WHERE status = 'processing'")
+
+        for table in PARTITIONED_TABLES:
+            if is_partitioned(cursor, table):
+                ensure_partitions(cursor, table)
+            else:
+                logger.warning(
+                    f"Table {table} is not partitioned, retention will fall back to DELETE; "
+                    f"run db/migrate_partitioning.sql to migrate it"
+                )
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        cursor.execute(
+            "INSERT INTO schema_version (version) VALUES (%s) ON CONFLICT DO NOTHING",
+            (SCHEMA_VERSION,)
+        )
+
+def schema_is_current() -> bool:
+    """Проверка, что create_tables уже применил текущую версию схемы"""
+    with get_db_cursor() as cursor:
+        cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            return False
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM schema_version WHERE version >= %s)", (SCHEMA_VERSION,))
+        return cursor.fetchone()[0]
+
+def is_partitioned(cursor, table: str) -> bool:
+    cursor.execute(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)",
+        (table,)
+    )
+    return cursor.fetchone() is not None
+
+def month_start(value: datetime, shift: int = 0) -> datetime:
+    month = value.year * 12 + value.month - 1 + shift
+    return datetime(month // 12, month % 12 + 1, 1)
+
+def partition_name(table: str, month: datetime) -> str:
+    return f"{table}_p{month:%Y%m}"
+
+def ensure_partitions(cursor, table: str, months_ahead: int = PARTITION_PREMAKE_MONTHS):
+    """Создает DEFAULT-секцию и помесячные секции на текущий и следующие месяцы.
+
+    Строки месяца, уже попавшие в DEFAULT-секцию, переносятся в новую секцию
+    до ее подключения, иначе PostgreSQL отказал бы в создании секции.
+    """
+    column = PARTITIONED_TABLES[table]
+    default = f"{table}_default"
+    # Несколько процессов обслуживают секции одновременно
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"partitions:{table}",))
+    cursor.execute(
+        sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT").format(
+            sql.Identifier(default), sql.Identifier(table)
+        )
+    )
+    now = datetime.utcnow()
+    for shift in range(months_ahead + 1):
+        start = month_start(now, shift)
+        end = month_start(start, 1)
+        name = partition_name(table, start)
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+        if cursor.fetchone()[0]:
+            continue
+
+        cursor.execute(
+            sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)").format(
+                sql.Identifier(name), sql.Identifier(table)
+            )
+        )
+        cursor.execute(
+            sql.SQL("""
+                WITH moved AS (
+                    DELETE FROM {default} WHERE {column} >= %s AND {column} < %s RETURNING *
+                )
+                INSERT INTO {name} SELECT * FROM moved
+            """).format(
+                default=sql.Identifier(default),
+                column=sql.Identifier(column),
+                name=sql.Identifier(name)
+            ),
+            (start, end)
+        )
+        if cursor.rowcount:
+            logger.warning(f"Moved {cursor.rowcount} rows from {default} into {name}")
+        cursor.execute(
+            sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)").format(
+                sql.Identifier(table), sql.Identifier(name)
+            ),
+            (start, end)
+        )
+
+def maintain_partitions():
+    # Каждая таблица в своей транзакции: ошибка одной не мешает остальным
+    for table in PARTITIONED_TABLES:
+        try:
+            with get_db_cursor() as cursor:
+                if is_partitioned(cursor, table):
+                    ensure_partitions(cursor, table)
+        except Exception as e:
+            logger.error(f"Partition maintenance failed for {table}: {str(e)}")
+
 def create_session(user_agent: str, ip_address: str) -> uuid.UUID:
     session_id = uuid.uuid4()
     with get_db_cursor() as cursor:
@@ -78,45 +253,232 @@ def create_session(user_agent: str, ip_address: str) -> uuid.UUID:
         )
     return session_id
 
+class MessageBuffer:
+    """Буфер отложенной записи сообщений.
+
+    Сообщения копятся в памяти и сбрасываются фоновым потоком одним
+    многострочным INSERT; обновления sessions.last_activity схлопываются
+    до одного UPDATE на сессию за сброс.
+    """
+
+    def __init__(self, interval: float, max_batch: int):
+        self.interval = interval
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._in_flight = []
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="message-flusher", daemon=True)
+            self._thread.start()
+
+    def add(self, row: tuple):
+        with self._lock:
+            self._pending.append(row)
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self._wakeup.set()
+
+    def pending_for(self, session_id_str: str) -> list:
+        """Сообщения сессии, которые еще могут отсутствовать в БД"""
+        with self._lock:
+            return [row for row in self._in_flight + self._pending if row[0] == session_id_str]
+
+    def _requeue(self, rows: list):
+        with self._lock:
+            self._pending = rows + self._pending
+            self._in_flight = []
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._in_flight = batch
+            if not batch:
+                return
+            try:
+                self._write(batch)
+            finally:
+                with self._lock:
+                    self._in_flight = []
+
+    def _write(self, batch: list):
+        try:
+            _write_messages(batch)
+            return
+        except psycopg2.IntegrityError:
+            pass
+        except Exception as e:
+            logger.error(f"Message flush failed, {len(batch)} rows requeued: {str(e)}")
+            self._requeue(batch)
+            raise
+
+        # Битая строка (например, несуществующая сессия) не должна блокировать
+        # всю пачку: пишем по одной и отбрасываем только ошибочные
+        for position, row in enumerate(batch):
+            try:
+                _write_messages([row])
+            except psycopg2.IntegrityError as e:
+                logger.error(f"Dropped message for session {row[0]}: {str(e)}")
+            except Exception as e:
+                logger.error(f"Message flush failed, {len(batch) - position} rows requeued: {str(e)}")
+                self._requeue(batch[position:])
+                raise
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+        for attempt in range(MESSAGE_SHUTDOWN_RETRIES):
+            try:
+                self.flush()
+                return
+            except Exception as e:
+                logger.warning(f"Final message flush attempt {attempt + 1} failed: {str(e)}")
+                time.sleep(1)
+
+        with self._lock:
+            lost = len(self._pending)
+        if lost:
+            logger.error(f"Message buffer shut down with {lost} unwritten messages lost")
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+_message_buffer = MessageBuffer(MESSAGE_FLUSH_INTERVAL, MESSAGE_FLUSH_BATCH) if MESSAGE_WRITE_BEHIND else None
+
+def _write_messages(rows: list):
+    # Последняя активность по каждой сессии в пачке
+    last_activity = {}
+    for session_id_str, timestamp, *_ in rows:
+        last_activity[session_id_str] = max(timestamp, last_activity.get(session_id_str, timestamp))
+
+    with get_db_cursor() as cursor:
+        execute_values(
+            cursor,
+            "INSERT INTO messages (session_id, timestamp, role, content, context, sources) VALUES %s",
+            rows,
+            page_size=len(rows)
+        )
+        execute_values(
+            cursor,
+            """
+            UPDATE sessions SET last_activity = v.ts
+            FROM (VALUES %s) AS v(session_id, ts)
+            WHERE sessions.session_id = v.session_id::uuid AND sessions.last_activity < v.ts
+            """,
+            sorted(last_activity.items()),
+            template="(%s, %s::timestamp)",
+            page_size=len(last_activity)
+        )
+
+def flush_messages():
+    if _message_buffer is not None:
+        _message_buffer.flush()
+
+def shutdown_message_buffer():
+    """Сбрасывает накопленные сообщения; вызывается при остановке процесса"""
+    if _message_buffer is not None:
+        _message_buffer.stop()
+
+if _message_buffer is not None:
+    atexit.register(shutdown_message_buffer)
+
 def save_message(session_id: uuid.UUID, role: str, content: str, context: str = None, sources: str = None): # type: ignore
+    session_id_str = str(session_id)
+    # Метка ставится здесь на обоих путях, чтобы сообщения сортировались одинаково
+    timestamp = datetime.utcnow()
+    if _message_buffer is not None:
+        _message_buffer.start()
+        _message_buffer.add((session_id_str, timestamp, role, content, context, sources))
+        return
+
     with get_db_cursor() as cursor:
-        session_id_str = str(session_id)
         cursor.execute(
-            "INSERT INTO messages (session_id, role, content, context, sources) VALUES (%s, %s, %s, %s, %s)",
-            (session_id_str, role, content, context, sources)
+            "INSERT INTO messages (session_id, timestamp, role, content, context, sources) VALUES (%s, %s, %s, %s, %s, %s)",
+            (session_id_str, timestamp, role, content, context, sources)
         )
         
         # Обновляем время последней активности сессии
         cursor.execute(
-            "UPDATE sessions SET last_activity = CURRENT_TIMESTAMP WHERE session_id = %s",
-            (session_id_str,)
+            "UPDATE sessions SET last_activity = GREATEST(last_activity, %s) WHERE session_id = %s",
+            (timestamp, session_id_str)
         )
 
+def _merge_pending(pending: list, rows: list) -> list:
+    """Дополняет строки (role, content, timestamp) из БД еще не записанными сообщениями"""
+    seen = set(rows)
+    merged = list(rows)
+    for _, timestamp, role, content, _, _ in pending:
+        row = (role, content, timestamp)
+        if row not in seen:
+            merged.append(row)
+    return merged
+
+def create_sessions(count: int, user_agent: str, ip_address: str) -> list[uuid.UUID]:
+    """Создает несколько сессий одним INSERT"""
+    session_ids = [uuid.uuid4() for _ in range(count)]
+    with get_db_cursor() as cursor:
+        execute_values(
+            cursor,
+            "INSERT INTO sessions (session_id, user_agent, ip_address) VALUES %s",
+            [(str(session_id), user_agent, ip_address) for session_id in session_ids],
+            page_size=count
+        )
+    return session_ids
+
 def get_session_history(session_id: uuid.UUID, limit: int = 10) -> list:
+    session_id_str = str(session_id)
+    # Снимок буфера берется до чтения из БД: строка, записанная между снимком
+    # и SELECT, попадет в оба набора и будет отброшена при слиянии
+    pending = _message_buffer.pending_for(session_id_str) if _message_buffer is not None else []
     with get_db_cursor() as cursor:
-        session_id_str = str(session_id)
         cursor.execute(
             "SELECT role, content, timestamp FROM messages WHERE session_id = %s ORDER BY timestamp DESC LIMIT %s",
             (session_id_str, limit)
         )
-        return cursor.fetchall()
+        history = cursor.fetchall()
+
+    if pending:
+        history = sorted(_merge_pending(pending, history), key=lambda row: row[2], reverse=True)[:limit]
+    return history
 
 def get_full_context(session_id: uuid.UUID) -> str:
+    session_id_str = str(session_id)
+    pending = _message_buffer.pending_for(session_id_str) if _message_buffer is not None else []
     with get_db_cursor() as cursor:
-        session_id_str = str(session_id)
         cursor.execute(
-            "SELECT role, content FROM messages WHERE session_id = %s ORDER BY timestamp",
+            "SELECT role, content, timestamp FROM messages WHERE session_id = %s ORDER BY timestamp",
             (session_id_str,)
         )
         history = cursor.fetchall()
+
+    if pending:
+        history = sorted(_merge_pending(pending, history), key=lambda row: row[2])
         
     context = []
-    for role, content in history:
+    for role, content, _ in history:
         context.append(f"{role.capitalize()}: {content}")
     
     return "\n\n".join(context)
 
-def create_async_task(session_id: uuid.UUID, username: str, user_id: str, question: str) -> uuid.UUID:
+def create_async_task(session_id: uuid.UUID, username: str, user_id: str, question: str,
+                      tenant: str|None = None) -> uuid.UUID:
     task_id = uuid.uuid4()
     with get_db_cursor() as cursor:
         session_id_str = str(session_id)
@@ -124,44 +486,157 @@ def create_async_task(session_id: uuid.UUID, username: str, user_id: str, questi
 
         cursor.execute(
             """
-            INSERT INTO async_tasks (task_id, session_id, username, user_id, question, status)
-            VALUES (%s, %s, %s, %s, %s, 'pending')
+            INSERT INTO async_tasks (task_id, session_id, username, user_id, question, tenant, status)
+            VALUES (%s, %s, %s, %s, %s, %s, 'pending')
             """,
-            (task_id_str, session_id_str, username, user_id, question)
+            (task_id_str, session_id_str, username, user_id, question, tenant)
         )
     return task_id
 
+def create_async_tasks(batch_id: uuid.UUID, session_ids: list[uuid.UUID], username: str, user_id: str,
+                       questions: list[str], embeddings: list[list[float]|None],
+                       tenant: str|None = None) -> list[uuid.UUID]:
+    """Создает задачи пакета одним INSERT вместе с заранее рассчитанными эмбеддингами.
+
+    batch_index сохраняет порядок вопросов: created_at у всех задач пакета одинаков.
+    """
+    task_ids = [uuid.uuid4() for _ in questions]
+    rows = [
+        (str(task_id), str(session_id), str(batch_id), index, username, user_id, question, embedding, tenant)
+        for index, (task_id, session_id, question, embedding)
+        in enumerate(zip(task_ids, session_ids, questions, embeddings))
+    ]
+    with get_db_cursor() as cursor:
+        execute_values(
+            cursor,
+            """
+            INSERT INTO async_tasks (task_id, session_id, batch_id, batch_index, username, user_id, question, query_embedding, tenant, status)
+            VALUES %s
+            """,
+            rows,
+            template="(%s, %s, %s, %s, %s, %s, %s, %s::real[], %s, 'pending')",
+            page_size=len(rows)
+        )
+    return task_ids
+
+_TASK_COLUMNS = [
+    "task_id", "session_id", "created_at", "started_at", "completed_at", "status",
+    "username", "user_id", "question", "answer", "error", "batch_id", "batch_index", "tenant"
+]
+
 def get_async_task(task_id: uuid.UUID) -> dict|None:
     with get_db_cursor() as cursor:
         task_id_str = str(task_id)
         cursor.execute(
-            """
-            SELECT task_id, session_id, created_at, started_at, completed_at, status, 
-                   username, user_id, question, answer, error
-            FROM async_tasks
-            WHERE task_id = %s
-            """,
+            sql.SQL("SELECT {} FROM async_tasks WHERE task_id = %s").format(
+                sql.SQL(", ").join(map(sql.Identifier, _TASK_COLUMNS))
+            ),
             (task_id_str,)
         )
         task = cursor.fetchone()
         if not task:
             return None
         
+        return dict(zip(_TASK_COLUMNS, task))
+
+def get_batch_tasks(batch_id: uuid.UUID) -> list[dict]:
+    with get_db_cursor() as cursor:
+        cursor.execute(
+            sql.SQL("SELECT {} FROM async_tasks WHERE batch_id = %s ORDER BY batch_index").format(
+                sql.SQL(", ").join(map(sql.Identifier, _TASK_COLUMNS))
+            ),
+            (str(batch_id),)
+        )
+        return [dict(zip(_TASK_COLUMNS, task)) for task in cursor.fetchall()]
+
+def claim_next_task(worker_id: str, lease_seconds: int) -> dict|None:
+    """Атомарно переводит самую старую ожидающую задачу в статус processing
+    и выдает воркеру аренду на lease_seconds"""
+    with get_db_cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE async_tasks
+            SET status = 'processing', started_at = CURRENT_TIMESTAMP,
+                worker_id = %s, attempts = attempts + 1, heartbeat_at = CURRENT_TIMESTAMP,
+                lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+            WHERE (task_id, created_at) = (
+                SELECT task_id, created_at
+                FROM async_tasks
+                WHERE status = 'pending'
+                ORDER BY created_at
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING task_id, session_id, question, query_embedding, tenant
+            """,
+            (worker_id, lease_seconds)
+        )
+        task = cursor.fetchone()
+        if not task:
+            return None
+
         return {
             "task_id": task[0],
             "session_id": task[1],
-            "created_at": task[2],
-            "started_at": task[3],
-            "completed_at": task[4],
-            "status": task[5],
-            "username": task[6],
-            "user_id": task[7],
-            "question": task[8],
-            "answer": task[9],
-            "error": task[10]
+            "question": task[2],
+            "query_embedding": task[3],
+            "tenant": task[4]
         }
 
-def update_task_status(task_id: uuid.UUID, status: str, answer: str|None, error: str|None):
+def heartbeat_tasks(task_ids: list, worker_id: str, lease_seconds: int):
+    """Продлевает аренду задач, которые воркер все еще обрабатывает"""
+    with get_db_cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE async_tasks
+            SET heartbeat_at = CURRENT_TIMESTAMP,
+                lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+            WHERE task_id = ANY(%s::uuid[]) AND status = 'processing' AND worker_id = %s
+            """,
+            (lease_seconds, [str(task_id) for task_id in task_ids], worker_id)
+        )
+
+def requeue_expired_tasks(max_attempts: int, lease_seconds: int) -> tuple[int, int]:
+    """Возвращает в очередь задачи с истекшей арендой (воркер упал или завис).
+
+    Задачи, исчерпавшие max_attempts, помечаются как failed. Для строк без
+    аренды (созданных до ее появления) срок считается от started_at.
+    Возвращает (число возвращенных, число проваленных).
+    """
+    expired = """
+        status = 'processing'
+        AND COALESCE(lease_expires_at, started_at + make_interval(secs => %s)) < CURRENT_TIMESTAMP
+    """
+    with get_db_cursor() as cursor:
+        cursor.execute(
+            f"""
+            UPDATE async_tasks
+            SET status = 'failed', completed_at = CURRENT_TIMESTAMP, worker_id = NULL,
+                lease_expires_at = NULL, query_embedding = NULL,
+                error = 'Task lease expired too many times'
+            WHERE {expired} AND attempts >= %s
+            """,
+            (lease_seconds, max_attempts)
+        )
+        failed = cursor.rowcount
+        cursor.execute(
+            f"""
+            UPDATE async_tasks
+            SET status = 'pending', started_at = NULL, worker_id = NULL, lease_expires_at = NULL
+            WHERE {expired}
+            """,
+            (lease_seconds,)
+        )
+        requeued = cursor.rowcount
+    return requeued, failed
+
+def update_task_status(task_id: uuid.UUID, status: str, answer: str|None, error: str|None,
+                       worker_id: str|None = None) -> bool:
+    """Обновляет статус задачи; возвращает False, если строка не изменилась.
+
+    С worker_id обновление применяется только пока задача в processing и
+    принадлежит этому воркеру: после истечения аренды задачу мог забрать другой.
+    """
     update_fields = ["status = %s"]
     params = [status]
     
@@ -175,6 +650,11 @@ def update_task_status(task_id: uuid.UUID, status: str, answer: str|None, error:
     # Добавляем временные метки
     if status in timestamp_updates:
         update_fields.append(f"{timestamp_updates[status]} = CURRENT_TIMESTAMP")
+
+    # Эмбеддинг нужен только до обработки, в завершенных задачах он лишь занимает место
+    if status in ('completed', 'failed'):
+        update_fields.append("query_embedding = NULL")
+        update_fields.append("lease_expires_at = NULL")
     
     # Добавляем дополнительные поля в зависимости от статуса
     field_mapping = {
@@ -189,9 +669,16 @@ def update_task_status(task_id: uuid.UUID, status: str, answer: str|None, error:
             params.append(field_value)
     
     # Формируем и выполняем запрос
+    conditions = ["task_id = %s"]
+    params.append(str(task_id))
+    if worker_id is not None:
+        conditions.append("worker_id = %s AND status = 'processing'")
+        params.append(worker_id)
+
     with get_db_cursor() as cursor:
-        query = sql.SQL("UPDATE async_tasks SET {} WHERE task_id = %s").format(
-            sql.SQL(', ').join(map(sql.SQL, update_fields))
+        query = sql.SQL("UPDATE async_tasks SET {} WHERE {}").format(
+            sql.SQL(', ').join(map(sql.SQL, update_fields)),
+            sql.SQL(' AND ').join(map(sql.SQL, conditions))
         )
-        params.append(str(task_id))
-        cursor.execute(query, params)
\ No newline at end of file
+        cursor.execute(query, params)
+        return cursor.rowcount > 0
\ No newline at end of file
@@ -1,24 +1,35 @@
 import os
+import re
 import uuid
+import gzip
+import hashlib
 import logging
 import asyncio
 from pathlib import Path
 from datetime import datetime
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException, Form # type: ignore
 from fastapi.middleware.cors import CORSMiddleware # type: ignore
 from fastapi.staticfiles import StaticFiles # type: ignore
-from fastapi.responses import HTMLResponse, JSONResponse # type: ignore
+from fastapi.responses import HTMLResponse, JSONResponse, Response # type: ignore
 
 # Локальные импорты
 from app.db import (
     create_tables,
+    schema_is_current,
+    maintain_partitions,
     create_session,
+    create_sessions,
     get_session_history,
     create_async_task,
-    get_async_task
+    create_async_tasks,
+    get_async_task,
+    get_batch_tasks,
+    shutdown_message_buffer
 )
 from app.rag import RAGProcessor
 from app.tasks import task_worker
+from app.retention import retention_worker
 
 # Создаем директорию для логов, если ее нет
 log_dir = Path("/app/logs")
@@ -36,17 +47,19 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.info("RAG application package initialized")
 
-app = FastAPI()
-rag = RAGProcessor()
+# Максимальное число вопросов в одном пакетном запросе
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "1000"))
 
-# Настройка CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Встроенный воркер задач; при запуске отдельного процесса app.worker отключается
+RUN_TASK_WORKER = os.getenv("RUN_TASK_WORKER", "true").lower() in ("1", "true", "yes")
+WARMUP_RETRY_INTERVAL = int(os.getenv("WARMUP_RETRY_INTERVAL", "5"))
+
+# Имя арендатора совпадает с подкаталогом загрузчика после нормализации
+TENANT_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+def check_tenant(tenant: str|None):
+    if tenant is not None and not TENANT_PATTERN.match(tenant):
+        raise HTTPException(status_code=400, detail="Invalid tenant")
 
 # Получаем абсолютный путь к директории со статическими файлами
 current_dir = Path(__file__).parent
@@ -57,27 +70,94 @@ if not static_dir.exists():
     logger.error(f"Static directory not found: {static_dir}")
     raise RuntimeError(f"Static directory not found: {static_dir}")
 
+# Главная страница отдается из памяти: тело, gzip-версия и ETag считаются один раз
+index_path = static_dir / "index.html"
+if not index_path.exists():
+    logger.error(f"index.html not found at {index_path}")
+    raise RuntimeError(f"index.html not found at {index_path}")
+index_html = index_path.read_bytes()
+index_html_gzip = gzip.compress(index_html)
+index_etag = f'"{hashlib.md5(index_html).hexdigest()}"'
+
+async def warm_up(app: FastAPI):
+    """Прогрев моделей и соединений; до успеха /readyz отвечает 503"""
+    while True:
+        try:
+            await app.state.rag.warm_up()
+            app.state.ready = True
+            logger.info("Backend is ready")
+            return
+        except Exception as e:
+            logger.warning(f"Warm-up failed, retrying in {WARMUP_RETRY_INTERVAL}s: {str(e)}")
+            await asyncio.sleep(WARMUP_RETRY_INTERVAL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # DDL выполняется только если схема устарела или еще не создана
+    if schema_is_current():
+        logger.info("Database schema is up to date")
+        # Секции текущего месяца должны существовать до приема запросов
+        maintain_partitions()
+    else:
+        create_tables()
+        logger.info("Database tables initialized")
+
+    app.state.ready = False
+    app.state.rag = RAGProcessor()
+    background = [
+        asyncio.create_task(warm_up(app)),
+        # Обслуживание секций и архивация устаревших данных
+        asyncio.create_task(retention_worker()),
+    ]
+
+    # Запускаем воркер асинхронных задач в фоне
+    worker_stop = asyncio.Event()
+    worker_task = asyncio.create_task(task_worker(app.state.rag, worker_stop)) if RUN_TASK_WORKER else None
+
+    yield
+
+    # Останавливаем встроенный воркер, дожидаясь текущих задач
+    if worker_task:
+        worker_stop.set()
+        await worker_task
+    for task in background:
+        task.cancel()
+
+    # Дописываем в БД сообщения, накопленные в буфере отложенной записи
+    shutdown_message_buffer()
+    logger.info("Message buffer flushed")
+    await app.state.rag.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# Настройка CORS
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
 # Mount static files
 app.mount("/static", StaticFiles(directory=str(static_dir)), name="static")
 
-@app.on_event("startup")
-async def startup_event():
-    create_tables()
-    logger.info("Database tables initialized")
-    
-    # Запускаем воркер асинхронных задач в фоне
-    asyncio.create_task(task_worker())
+@app.get("/readyz")
+async def readyz(request: Request):
+    if not request.app.state.ready:
+        return JSONResponse(content={"status": "warming up"}, status_code=503)
+    return {"status": "ready"}
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
-    # Используем правильный путь к файлу
-    index_path = static_dir / "index.html"
-    if not index_path.exists():
-        logger.error(f"index.html not found at {index_path}")
-        raise HTTPException(status_code=404, detail="Home page not found")
-    
-    with open(index_path, "r") as f:
-        return HTMLResponse(content=f.read(), status_code=200)
+    headers = {"ETag": index_etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if index_etag in request.headers.get("If-None-Match", ""):
+        return Response(status_code=304, headers=headers)
+
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return HTMLResponse(content=index_html_gzip, status_code=200, headers=headers)
+    return HTMLResponse(content=index_html, status_code=200, headers=headers)
 
 @app.post("/api/session")
 async def create_new_session(request: Request):
@@ -96,12 +176,13 @@ async def get_history(session_id: uuid.UUID):
     ]
 
 @app.get("/api/query")
-async def query_endpoint(q: str, session_id: uuid.UUID):
+async def query_endpoint(request: Request, q: str, session_id: uuid.UUID, tenant: str|None = None):
     if not q or len(q) < 3:
         raise HTTPException(status_code=400, detail="Query too short")
+    check_tenant(tenant)
     
     try:
-        result = await rag.process_query(q, session_id)
+        result = await request.app.state.rag.process_query(q, session_id, tenant=tenant)
         return JSONResponse(content=result)
     except Exception as e:
         logger.error(f"Query processing error: {str(e)}")
@@ -115,12 +196,15 @@ class AsyncQueryRequest(BaseModel):
     user_id: str
     question: str
     session_id: uuid.UUID = None # type: ignore
+    tenant: str|None = None
 
 @app.post("/api/async-query")
 async def create_async_query(
     request: Request,
     data: AsyncQueryRequest
 ):
+    check_tenant(data.tenant)
+
     # Создаем новую сессию, если не предоставлена
     if not data.session_id:
         session_id = create_session(
@@ -131,7 +215,7 @@ async def create_async_query(
         session_id = data.session_id
     
     # Создаем асинхронную задачу
-    task_id = create_async_task(session_id, data.username, data.user_id, data.question)
+    task_id = create_async_task(session_id, data.username, data.user_id, data.question, tenant=data.tenant)
     
     logger.info(f"Created async task: {task_id} for user: {data.user_id}")
     
@@ -142,12 +226,7 @@ async def create_async_query(
         "created_at": datetime.utcnow().isoformat()
     }
 
-@app.get("/api/async-result/{task_id}")
-async def get_async_result(task_id: uuid.UUID):
-    task = get_async_task(task_id)
-    if not task:
-        raise HTTPException(status_code=404, detail="Task not found")
-    
+def serialize_task(task: dict) -> dict:
     # Преобразуем временные метки в строки
     if task["created_at"]:
         task["created_at"] = task["created_at"].isoformat()
@@ -155,6 +234,76 @@ async def get_async_result(task_id: uuid.UUID):
         task["started_at"] = task["started_at"].isoformat()
     if task["completed_at"]:
         task["completed_at"] = task["completed_at"].isoformat()
+    return task
+
+@app.get("/api/async-result/{task_id}")
+async def get_async_result(task_id: uuid.UUID):
+    task = get_async_task(task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
     
-    return JSONResponse(content=task)
+    return JSONResponse(content=serialize_task(task))
+
+class BatchAsyncQueryRequest(BaseModel):
+    username: str
+    user_id: str
+    questions: list[str]
+    tenant: str|None = None
+
+@app.post("/api/async-query/batch")
+async def create_async_query_batch(
+    request: Request,
+    data: BatchAsyncQueryRequest
+):
+    if not data.questions:
+        raise HTTPException(status_code=400, detail="No questions provided")
+    if len(data.questions) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Batch too large (max {MAX_BATCH_SIZE})")
+    check_tenant(data.tenant)
+
+    # Каждому вопросу своя сессия, чтобы ответы не смешивали историю диалога
+    session_ids = create_sessions(
+        len(data.questions),
+        user_agent=request.headers.get("User-Agent", ""),
+        ip_address=request.client.host if request.client else ""
+    )
+
+    # Эмбеддинги всех вопросов одним пакетным запросом; при ошибке воркер
+    # рассчитает их по одному
+    embeddings = await request.app.state.rag.get_embeddings(data.questions) or [None] * len(data.questions)
+
+    batch_id = uuid.uuid4()
+    task_ids = create_async_tasks(
+        batch_id, session_ids, data.username, data.user_id, data.questions, embeddings, tenant=data.tenant
+    )
+
+    logger.info(f"Created async batch: {batch_id} with {len(task_ids)} tasks for user: {data.user_id}")
+
+    return {
+        "batch_id": str(batch_id),
+        "status": "pending",
+        "created_at": datetime.utcnow().isoformat(),
+        "tasks": [
+            {"task_id": str(task_id), "session_id": str(session_id)}
+            for task_id, session_id in zip(task_ids, session_ids)
+        ]
+    }
+
+@app.get("/api/async-batch/{batch_id}")
+async def get_async_batch(batch_id: uuid.UUID):
+    tasks = get_batch_tasks(batch_id)
+    if not tasks:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+    counts = {}
+    for task in tasks:
+        counts[task["status"]] = counts.get(task["status"], 0) + 1
+
+    return JSONResponse(content={
+        "batch_id": str(batch_id),
+        "total": len(tasks),
+        "counts": counts,
+        "done": counts.get("completed", 0) + counts.get("failed", 0) == len(tasks),
+        "tasks": [serialize_task(task) for task in tasks]
+    })
 
@@ -1,8 +1,11 @@
 import os
 import uuid
+import asyncio
 import logging
 import httpx
+import numpy as np
 from qdrant_client import QdrantClient
+from qdrant_client.http import models
 from .db import save_message, get_full_context
 
 class RAGProcessor:
@@ -16,29 +19,93 @@ class RAGProcessor:
             api_key=os.getenv("QDRANT_API_KEY")
         )
         self.collection_name = os.getenv("COLLECTION_NAME", "documents")
+        # Должны совпадать с настройками загрузчика
+        self.tenant_mode = os.getenv("TENANT_MODE", "payload")
+        self.default_tenant = os.getenv("DEFAULT_TENANT", "default")
         
         # Конфигурация Ollama
         self.ollama_host = os.getenv("OLLAMA_HOST", "http://ollama:11434")
         self.ollama_model = os.getenv("OLLAMA_MODEL", "qwen2.5-coder:latest")
         self.embedding_model = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")
+        self.embed_batch_size = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+        # Сколько Ollama держит модели в памяти после последнего запроса
+        self.ollama_keep_alive = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+        # Общий клиент: соединения с Ollama переиспользуются между запросами
+        self.http = httpx.AsyncClient(timeout=120.0)
+
+        # Постобработка найденного контекста
+        self.search_top_k = int(os.getenv("SEARCH_TOP_K", "3"))
+        self.search_fetch_k = int(os.getenv("SEARCH_FETCH_K", "20"))
+        self.mmr_lambda = float(os.getenv("MMR_LAMBDA", "0.7"))
+        self.duplicate_threshold = float(os.getenv("DUPLICATE_THRESHOLD", "0.95"))
+        self.context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+        self.chars_per_token = float(os.getenv("CHARS_PER_TOKEN", "3.5"))
         
         self.logger.info("RAG processor initialized")
 
     async def get_embedding(self, text: str) -> list[float]:
         """Получение эмбеддинга из Ollama"""
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.ollama_host}/api/embeddings",
-                json={
-                    "model": self.embedding_model,
-                    "prompt": text
-                },
-                timeout=30.0
-            )
+        response = await self.http.post(
+            f"{self.ollama_host}/api/embeddings",
+            json={
+                "model": self.embedding_model,
+                "prompt": text,
+                "keep_alive": self.ollama_keep_alive
+            },
+            timeout=30.0
+        )
+        if response.status_code != 200:
+            self.logger.error(f"Ollama embedding error: {response.text}")
+            return []
+        return response.json().get("embedding", [])
+
+    async def get_embeddings(self, texts: list[str]) -> list[list[float]]:
+        """Пакетное получение эмбеддингов через /api/embed; пустой список при ошибке"""
+        embeddings = []
+        for start in range(0, len(texts), self.embed_batch_size):
+            batch = texts[start:start + self.embed_batch_size]
+            try:
+                response = await self.http.post(
+                    f"{self.ollama_host}/api/embed",
+                    json={
+                        "model": self.embedding_model,
+                        "input": batch,
+                        "keep_alive": self.ollama_keep_alive
+                    },
+                    timeout=120.0
+                )
+            except httpx.HTTPError as e:
+                self.logger.error(f"Ollama batch embedding error: {str(e)}")
+                return []
             if response.status_code != 200:
-                self.logger.error(f"Ollama embedding error: {response.text}")
+                self.logger.error(f"Ollama batch embedding error: {response.text}")
                 return []
-            return response.json().get("embedding", [])
+            embeddings.extend(response.json().get("embeddings", []))
+        return embeddings if len(embeddings) == len(texts) else []
+
+    async def warm_up(self):
+        """Загружает модели Ollama в память и открывает соединения с Ollama и Qdrant.
+
+        Пустой prompt в /api/generate только загружает модель, не генерируя ответ.
+        Исключение означает, что сервис еще не готов.
+        """
+        response = await self.http.post(
+            f"{self.ollama_host}/api/embed",
+            json={"model": self.embedding_model, "input": "warm-up", "keep_alive": self.ollama_keep_alive}
+        )
+        response.raise_for_status()
+        response = await self.http.post(
+            f"{self.ollama_host}/api/generate",
+            json={"model": self.ollama_model, "prompt": "", "keep_alive": self.ollama_keep_alive}
+        )
+        response.raise_for_status()
+        # Коллекцию создает загрузчик, поэтому проверяем только доступность Qdrant
+        await asyncio.to_thread(self.qdrant_client.get_collections)
+        self.logger.info("RAG processor warmed up")
+
+    async def close(self):
+        await self.http.aclose()
+        self.qdrant_client.close()
 
     def generate_prompt(self, query: str, context: str, history: str) -> str:
         return f"""
@@ -56,51 +123,166 @@ class RAGProcessor:
         """
 
     async def generate_response(self, prompt: str) -> str:
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            try:
-                response = await client.post(
-                    f"{self.ollama_host}/api/generate",
-                    json={
-                        "model": self.ollama_model,
-                        "prompt": prompt,
-                        "stream": False
-                    }
-                )
-                response.raise_for_status()
-                return response.json()["response"]
-            except Exception as e:
-                self.logger.error(f"Ollama error: {str(e)}")
-                return "Произошла ошибка при генерации ответа"
+        try:
+            response = await self.http.post(
+                f"{self.ollama_host}/api/generate",
+                json={
+                    "model": self.ollama_model,
+                    "prompt": prompt,
+                    "stream": False,
+                    "keep_alive": self.ollama_keep_alive
+                }
+            )
+            response.raise_for_status()
+            return response.json()["response"]
+        except Exception as e:
+            self.logger.error(f"Ollama error: {str(e)}")
+            return "Произошла ошибка при генерации ответа"
+
+    def select_mmr(self, query_vector: list, vectors: list, top_k: int) -> list[int]:
+        """Maximal Marginal Relevance: индексы кандидатов, релевантных запросу и непохожих друг на друга.
+
+        Кандидаты, почти совпадающие с уже выбранными (косинус выше duplicate_threshold),
+        отбрасываются полностью.
+        """
+        candidates = np.asarray(vectors, dtype=np.float32)
+        candidates /= np.linalg.norm(candidates, axis=1, keepdims=True) + 1e-12
+        query = np.asarray(query_vector, dtype=np.float32)
+        query /= np.linalg.norm(query) + 1e-12
+
+        relevance = candidates @ query
+        similarity = candidates @ candidates.T
+
+        selected = [int(np.argmax(relevance))]
+        max_similarity = similarity[selected[0]].copy()
+        excluded = max_similarity >= self.duplicate_threshold
+        # Выбранный кандидат исключается явно: при пороге >= 1 сходство с собой его не отсекает
+        excluded[selected[0]] = True
+
+        while len(selected) < top_k:
+            scores = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * max_similarity
+            scores[excluded] = -np.inf
+            best = int(np.argmax(scores))
+            if scores[best] == -np.inf:
+                break
+            selected.append(best)
+            max_similarity = np.maximum(max_similarity, similarity[best])
+            excluded |= similarity[best] >= self.duplicate_threshold
+            excluded[best] = True
+
+        return selected
+
+    @staticmethod
+    def merge_adjacent(hits: list) -> list[str]:
+        """Склеивает соседние чанки одного файла; порядок групп - по лучшей релевантности"""
+        by_file = {}
+        for order, hit in enumerate(hits):
+            by_file.setdefault(hit.payload.get("filename"), []).append((order, hit))
 
-    def search_context(self, query_embedding: list, top_k: int = 3) -> str:
+        groups = []
+        for file_hits in by_file.values():
+            file_hits.sort(key=lambda item: item[1].payload.get("chunk_index", 0))
+            run = [file_hits[0]]
+            for item in file_hits[1:]:
+                if item[1].payload.get("chunk_index", 0) == run[-1][1].payload.get("chunk_index", 0) + 1:
+                    run.append(item)
+                else:
+                    groups.append(run)
+                    run = [item]
+            groups.append(run)
+
+        groups.sort(key=lambda run: min(order for order, _ in run))
+        return [" ".join(hit.payload["text"] for _, hit in run) for run in groups]
+
+    def fit_token_budget(self, passages: list[str]) -> list[str]:
+        """Обрезает список фрагментов по оценочному бюджету токенов"""
+        budget_chars = int(self.context_token_budget * self.chars_per_token)
+        fitted = []
+        for passage in passages:
+            if budget_chars <= 0:
+                break
+            if len(passage) > budget_chars:
+                passage = passage[:budget_chars].rsplit(" ", 1)[0]
+            fitted.append(passage)
+            budget_chars -= len(passage)
+        return fitted
+
+    def search_scope(self, tenant: str|None) -> tuple[str, models.Filter|None]:
+        """Коллекция и фильтр для поиска в данных арендатора; без арендатора - по всей базовой коллекции"""
+        if not tenant:
+            return self.collection_name, None
+        if self.tenant_mode == "collection":
+            if tenant == self.default_tenant:
+                return self.collection_name, None
+            return f"{self.collection_name}_{tenant}", None
+        return self.collection_name, models.Filter(
+            must=[models.FieldCondition(key="tenant", match=models.MatchValue(value=tenant))]
+        )
+
+    def search_context(self, query_embedding: list, top_k: int|None = None, tenant: str|None = None) -> str:
+        top_k = top_k or self.search_top_k
+        collection_name, query_filter = self.search_scope(tenant)
         try:
+            # Берем кандидатов с запасом вместе с векторами для MMR
             search_result = self.qdrant_client.search(
-                collection_name=self.collection_name,
+                collection_name=collection_name,
                 query_vector=query_embedding,
-                limit=top_k,
-                with_payload=True
+                query_filter=query_filter,
+                limit=max(top_k, self.search_fetch_k),
+                with_payload=True,
+                with_vectors=True
             )
-            
+            if not search_result:
+                return ""
+
+            selected = self.select_mmr(query_embedding, [hit.vector for hit in search_result], top_k)
+            passages = self.fit_token_budget(self.merge_adjacent([search_result[i] for i in selected]))
+
             context = "\n\n".join(
-                f"Источник {i+1}:\n{result.payload['text']}" 
-                for i, result in enumerate(search_result)
+                f"Источник {i+1}:\n{passage}" 
+                for i, passage in enumerate(passages)
             )
             return context
         except Exception as e:
             self.logger.error(f"Vector search error: {str(e)}")
             return ""
 
-    async def process_query(self, query: str, session_id: uuid.UUID) -> dict:
+    @staticmethod
+    def save_answer(session_id: uuid.UUID, response: str, context: str):
+        save_message(
+            session_id, 
+            "assistant", 
+            response,
+            context=context[:1000],
+            sources=str(len(context.split("Источник"))))
+
+    def save_exchange(self, session_id: uuid.UUID, query: str, response: str, context: str = ""):
+        """Сохраняет вопрос и ответ, полученные через process_query(save_history=False)"""
+        save_message(session_id, "user", query)
+        self.save_answer(session_id, response, context)
+
+    async def process_query(self, query: str, session_id: uuid.UUID, query_embedding: list[float]|None = None,
+                            tenant: str|None = None, save_history: bool = True) -> dict:
+        """Отвечает на запрос с учетом истории сессии.
+
+        С save_history=False вопрос и ответ не сохраняются, а контекст
+        возвращается в результате: асинхронная задача вызывает save_exchange
+        только после того, как подтвердила владение арендой.
+        """
         self.logger.info(f"Processing query: '{query}' for session {session_id}")
         
         # Сохраняем запрос пользователя
-        save_message(session_id, "user", query)
+        if save_history:
+            save_message(session_id, "user", query)
         
         # Получаем историю диалога
         history = get_full_context(session_id)
+        if not save_history:
+            history = "\n\n".join(part for part in (history, f"User: {query}") if part)
         
-        # Получаем эмбеддинг запроса
-        query_embedding = await self.get_embedding(query)
+        # Получаем эмбеддинг запроса, если он не был рассчитан заранее
+        if not query_embedding:
+            query_embedding = await self.get_embedding(query)
         if not query_embedding:
             return {
                 "query": query,
@@ -109,7 +291,7 @@ class RAGProcessor:
             }
         
         # Поиск релевантного контекста
-        context = self.search_context(query_embedding)
+        context = self.search_context(query_embedding, tenant=tenant)
         self.logger.debug(f"Retrieved context: {context[:200]}...")
         
         # Генерация промпта с историей
@@ -119,13 +301,16 @@ class RAGProcessor:
         # Запрос к Ollama
         response = await self.generate_response(prompt)
         
+        if not save_history:
+            return {
+                "query": query,
+                "response": response,
+                "session_id": str(session_id),
+                "context": context
+            }
+
         # Сохраняем ответ ассистента
-        save_message(
-            session_id, 
-            "assistant", 
-            response,
-            context=context[:1000],
-            sources=str(len(context.split("Источник"))))
+        self.save_answer(session_id, response, context)
         
         return {
             "query": query,
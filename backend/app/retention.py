@@ -0,0 +1,189 @@
+import os
+import gzip
+import asyncio
+import logging
+from pathlib import Path
+from datetime import datetime, timedelta
+from psycopg2 import sql
+from .db import (
+    PARTITIONED_TABLES,
+    get_db_connection,
+    is_partitioned,
+    maintain_partitions,
+    month_start,
+)
+
+logger = logging.getLogger("Retention")
+
+RETENTION_ENABLED = os.getenv("RETENTION_ENABLED", "false").lower() in ("1", "true", "yes")
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", "3600"))
+ARCHIVE_DIR = Path(os.getenv("ARCHIVE_DIR", "/app/archive"))
+
+# Срок хранения в днях для каждой таблицы
+RETENTION_DAYS = {
+    "messages": int(os.getenv("MESSAGES_RETENTION_DAYS", "180")),
+    "async_tasks": int(os.getenv("ASYNC_TASKS_RETENTION_DAYS", "30")),
+    "sessions": int(os.getenv("SESSIONS_RETENTION_DAYS", "211")),
+}
+
+# Сессия удаляется только когда ее сообщения уже выгружены вместе с секцией:
+# месячная секция истекает до 31 дня позже самого сообщения
+if RETENTION_ENABLED and RETENTION_DAYS["sessions"] < RETENTION_DAYS["messages"] + 31:
+    raise ValueError(
+        f"SESSIONS_RETENTION_DAYS ({RETENTION_DAYS['sessions']}) must be at least "
+        f"MESSAGES_RETENTION_DAYS + 31 ({RETENTION_DAYS['messages'] + 31})"
+    )
+
+# Сессии, на которые еще ссылаются сообщения или задачи, не удаляются:
+# иначе ON DELETE CASCADE удалил бы сообщения мимо архива
+ORPHANED_SESSION = sql.SQL("""
+    NOT EXISTS (SELECT 1 FROM messages m WHERE m.session_id = sessions.session_id)
+    AND NOT EXISTS (SELECT 1 FROM async_tasks t WHERE t.session_id = sessions.session_id)
+""")
+
+# Ключ advisory-блокировки: при нескольких воркерах uvicorn архивацию
+# выполняет только один процесс
+RETENTION_LOCK_ID = 727001
+
+def _archive_path(table: str, name: str) -> Path:
+    path = ARCHIVE_DIR / table / f"{name}.csv.gz"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+def _export(cursor, query: sql.Composable, path: Path):
+    """Выгружает результат запроса в сжатый CSV; файл появляется только после полной записи"""
+    tmp_path = path.with_suffix(".tmp")
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        cursor.copy_expert(
+            sql.SQL("COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)").format(query).as_string(cursor),
+            f
+        )
+    os.replace(tmp_path, path)
+
+def expired_partitions(cursor, table: str, cutoff: datetime) -> list:
+    """Помесячные секции, все строки которых старше cutoff"""
+    cursor.execute(
+        """
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = to_regclass(%s)
+        """,
+        (table,)
+    )
+    prefix = f"{table}_p"
+    expired = []
+    for (name,) in cursor.fetchall():
+        suffix = name[len(prefix):]
+        if not name.startswith(prefix) or len(suffix) != 6 or not suffix.isdigit():
+            continue
+        month = datetime(int(suffix[:4]), int(suffix[4:]), 1)
+        if month_start(month, 1) <= cutoff:
+            expired.append(name)
+    return sorted(expired)
+
+def archive_partition(conn, table: str, partition: str):
+    with conn.cursor() as cursor:
+        _export(
+            cursor,
+            sql.SQL("SELECT * FROM {}").format(sql.Identifier(partition)),
+            _archive_path(table, partition)
+        )
+        cursor.execute(
+            sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(
+                sql.Identifier(table), sql.Identifier(partition)
+            )
+        )
+        cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(partition)))
+    conn.commit()
+    logger.info(f"Archived and dropped partition {partition}")
+
+def archive_rows(conn, table: str, column: str, cutoff: datetime, extra: sql.Composable|None = None):
+    """Архивация для несекционированных таблиц: выгрузка и DELETE устаревших строк.
+
+    extra - дополнительное условие отбора удаляемых строк.
+    """
+    condition = sql.SQL("{} < %s").format(sql.Identifier(column))
+    if extra is not None:
+        condition = sql.SQL("{} AND {}").format(condition, extra)
+    with conn.cursor() as cursor:
+        cursor.execute(
+            sql.SQL("SELECT EXISTS (SELECT 1 FROM {} WHERE {})").format(sql.Identifier(table), condition),
+            (cutoff,)
+        )
+        if not cursor.fetchone()[0]:
+            conn.commit()
+            return
+
+        select = sql.SQL("SELECT * FROM {} WHERE {}").format(sql.Identifier(table), condition)
+        _export(
+            cursor,
+            sql.SQL(cursor.mogrify(select, (cutoff,)).decode()),
+            _archive_path(table, f"{table}_{datetime.utcnow():%Y%m%d%H%M%S}")
+        )
+        cursor.execute(
+            sql.SQL("DELETE FROM {} WHERE {}").format(sql.Identifier(table), condition),
+            (cutoff,)
+        )
+        deleted = cursor.rowcount
+    conn.commit()
+    logger.info(f"Archived and deleted {deleted} rows from {table}")
+
+def run_retention():
+    """Один цикл обслуживания: создание будущих секций и архивация устаревших данных"""
+    maintain_partitions()
+    if not RETENTION_ENABLED:
+        return
+
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (RETENTION_LOCK_ID,))
+            locked = cursor.fetchone()[0]
+        conn.commit()
+        if not locked:
+            logger.debug("Retention is running in another process")
+            return
+
+        # Блокировка сессионная и снимается при закрытии соединения
+        now = datetime.utcnow()
+        for table, column in PARTITIONED_TABLES.items():
+            cutoff = now - timedelta(days=RETENTION_DAYS[table])
+            try:
+                with conn.cursor() as cursor:
+                    partitioned = is_partitioned(cursor, table)
+                    partitions = expired_partitions(cursor, table, cutoff) if partitioned else []
+                conn.commit()
+
+                # Для секционированной таблицы DELETE затрагивает только DEFAULT-секцию,
+                # куда попадают строки вне заранее созданных диапазонов
+                archive_rows(conn, f"{table}_default" if partitioned else table, column, cutoff)
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Retention failed for {table}: {str(e)}")
+                continue
+
+            for partition in partitions:
+                try:
+                    archive_partition(conn, table, partition)
+                except Exception as e:
+                    conn.rollback()
+                    logger.error(f"Archiving partition {partition} failed: {str(e)}")
+
+        try:
+            archive_rows(
+                conn, "sessions", "last_activity",
+                now - timedelta(days=RETENTION_DAYS["sessions"]),
+                extra=ORPHANED_SESSION
+            )
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Retention failed for sessions: {str(e)}")
+
+async def retention_worker():
+    logger.info(f"Retention worker started (archival {'enabled' if RETENTION_ENABLED else 'disabled'})")
+    while True:
+        try:
+            await asyncio.to_thread(run_retention)
+        except Exception as e:
+            logger.error(f"Retention error: {str(e)}")
+        await asyncio.sleep(RETENTION_INTERVAL)
@@ -1,75 +1,140 @@
+import os
+import time
+import socket
 import asyncio
-import uuid
 import logging
-from .db import get_async_task, get_db_cursor, update_task_status
+from .db import claim_next_task, heartbeat_tasks, requeue_expired_tasks, update_task_status
 from .rag import RAGProcessor
 
 logger = logging.getLogger("AsyncTasks")
-rag = RAGProcessor()
 
-async def process_async_task(task_id: uuid.UUID):
-    # Обновляем статус задачи на "в обработке"
-    update_task_status(task_id, 'processing', None, None)
-    
+# Максимальное число одновременно генерируемых ответов на процесс
+TASK_CONCURRENCY = int(os.getenv("TASK_CONCURRENCY", "2"))
+
+# Аренда задач: воркер продлевает ее heartbeat'ом, просроченные задачи
+# возвращаются в очередь любым живым воркером
+WORKER_ID = os.getenv("TASK_WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+TASK_LEASE_SECONDS = int(os.getenv("TASK_LEASE_SECONDS", "60"))
+TASK_HEARTBEAT_INTERVAL = int(os.getenv("TASK_HEARTBEAT_INTERVAL", "15"))
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "3"))
+TASK_REAPER_INTERVAL = int(os.getenv("TASK_REAPER_INTERVAL", "30"))
+TASK_DRAIN_TIMEOUT = int(os.getenv("TASK_DRAIN_TIMEOUT", "120"))
+
+async def process_async_task(task: dict, rag: RAGProcessor):
+    task_id = task['task_id']
     try:
-        # Получаем данные задачи
-        task = get_async_task(task_id)
-        if not task:
-            logger.error(f"Task not found: {task_id}")
-            return
-        
-        question = task['question']
-        session_id = task['session_id']
-        
-        # Обрабатываем запрос
-        result = await rag.process_query(question, session_id)
-        
-        # Обновляем статус задачи на "завершено"
-        update_task_status(
-            task_id, 
-            'completed', 
-            answer=result['response'],
-            error  =None
+        # Обрабатываем запрос (эмбеддинг мог быть рассчитан при пакетной постановке)
+        result = await rag.process_query(
+            task['question'],
+            task['session_id'],
+            query_embedding=task.get('query_embedding'),
+            tenant=task.get('tenant'),
+            # История сессии пишется только после подтверждения аренды, иначе
+            # повторная попытка задачи продублировала бы вопрос и ответ
+            save_history=False
         )
-        
-        logger.info(f"Task completed: {task_id}")
-        
+
+        # Обновляем статус задачи на "завершено"
+        status, answer, error = 'completed', result['response'], None
     except Exception as e:
         logger.error(f"Task failed: {task_id}, error: {str(e)}")
-        update_task_status(
-            task_id, 
-            'failed', 
-            answer= None,
-            error=str(e)
-        )
+        status, answer, error = 'failed', None, str(e)
+
+    # Результат записывается, только если аренда все еще принадлежит этому воркеру
+    try:
+        updated = update_task_status(task_id, status, answer=answer, error=error, worker_id=WORKER_ID)
+    except Exception as e:
+        # Задача останется в processing и вернется в очередь по истечении аренды
+        logger.error(f"Saving result of task {task_id} failed: {str(e)}")
+        return
+    if not updated:
+        logger.warning(f"Task {task_id} lease was lost, {status} result dropped")
+        return
+
+    if status == 'completed':
+        try:
+            rag.save_exchange(task['session_id'], task['question'], answer, result.get('context', ""))
+        except Exception as e:
+            logger.error(f"Saving history of task {task_id} failed: {str(e)}")
+        logger.info(f"Task completed: {task_id}")
 
-async def task_worker():
-    logger.info("Async task worker started")
+async def heartbeat_loop(in_flight: dict):
     while True:
+        await asyncio.sleep(TASK_HEARTBEAT_INTERVAL)
+        if not in_flight:
+            continue
         try:
-            # Получаем следующую задачу из очереди
-            task = get_next_pending_task()
-            if task:
-                task_id = task['task_id']
-                logger.info(f"Processing task: {task_id}")
-                await process_async_task(task_id)
-            else:
-                await asyncio.sleep(1)
+            heartbeat_tasks(list(in_flight.values()), WORKER_ID, TASK_LEASE_SECONDS)
         except Exception as e:
-            logger.error(f"Task worker error: {str(e)}")
-            await asyncio.sleep(5)
-
-def get_next_pending_task():
-    with get_db_cursor() as cursor:
-        cursor.execute(
-            """
-            SELECT task_id 
-            FROM async_tasks 
-            WHERE status = 'pending' 
-            ORDER BY created_at 
-            LIMIT 1
-            FOR UPDATE SKIP LOCKED
-            """
-        )
-        task = cursor.fetchone()
-        return {'task_id': task[0]} if task else None
\ No newline at end of file
+            logger.error(f"Task heartbeat error: {str(e)}")
+
+def reap_expired_tasks():
+    requeued, failed = requeue_expired_tasks(TASK_MAX_ATTEMPTS, TASK_LEASE_SECONDS)
+    if requeued or failed:
+        logger.warning(f"Expired task leases: {requeued} requeued, {failed} failed")
+
+async def drain(in_flight: dict):
+    """Дожидается выполняющихся задач; оставшиеся по таймауту вернет в очередь
+    истечение аренды"""
+    if not in_flight:
+        return
+    logger.info(f"Draining {len(in_flight)} in-flight tasks")
+    _, pending = await asyncio.wait(list(in_flight), timeout=TASK_DRAIN_TIMEOUT)
+    for running in pending:
+        running.cancel()
+    if pending:
+        logger.warning(f"{len(pending)} tasks left unfinished, their leases will expire")
+
+async def task_worker(rag: RAGProcessor, stop: asyncio.Event|None = None):
+    """Цикл обработки очереди; при установке stop перестает брать новые задачи
+    и дожидается текущих"""
+    stop = stop or asyncio.Event()
+    logger.info(f"Async task worker {WORKER_ID} started (concurrency={TASK_CONCURRENCY})")
+    slots = asyncio.Semaphore(TASK_CONCURRENCY)
+    in_flight = {}
+    heartbeat = asyncio.create_task(heartbeat_loop(in_flight))
+    last_reap = 0.0
+
+    async def pause(seconds: float):
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    try:
+        while not stop.is_set():
+            if time.monotonic() - last_reap >= TASK_REAPER_INTERVAL:
+                last_reap = time.monotonic()
+                try:
+                    reap_expired_tasks()
+                except Exception as e:
+                    logger.error(f"Task reaper error: {str(e)}")
+
+            await slots.acquire()
+            if stop.is_set():
+                slots.release()
+                break
+            try:
+                # Забираем следующую задачу из очереди, помечая ее как processing
+                task = claim_next_task(WORKER_ID, TASK_LEASE_SECONDS)
+            except Exception as e:
+                slots.release()
+                logger.error(f"Task worker error: {str(e)}")
+                await pause(5)
+                continue
+
+            if not task:
+                slots.release()
+                await pause(1)
+                continue
+
+            logger.info(f"Processing task: {task['task_id']}")
+            running = asyncio.create_task(process_async_task(task, rag))
+            in_flight[running] = task['task_id']
+            running.add_done_callback(lambda done: in_flight.pop(done, None))
+            running.add_done_callback(lambda _: slots.release())
+
+        await drain(in_flight)
+    finally:
+        heartbeat.cancel()
+    logger.info(f"Async task worker {WORKER_ID} stopped")
@@ -0,0 +1,48 @@
+"""Отдельный процесс обработки асинхронных задач.
+
+Запуск: python -m app.worker
+"""
+import os
+import signal
+import asyncio
+import logging
+from pathlib import Path
+from app.db import shutdown_message_buffer
+from app.rag import RAGProcessor
+from app.tasks import task_worker
+
+log_dir = Path("/app/logs")
+log_dir.mkdir(parents=True, exist_ok=True)
+
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+    handlers=[
+        logging.StreamHandler(),
+        logging.FileHandler("/app/logs/worker.log")
+    ]
+)
+logger = logging.getLogger(__name__)
+
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    rag = RAGProcessor()
+    # Прогрев не обязателен: при ошибке модель загрузится первой задачей
+    try:
+        await rag.warm_up()
+    except Exception as e:
+        logger.warning(f"Warm-up failed: {str(e)}")
+
+    await task_worker(rag, stop)
+
+    # Дописываем в БД сообщения, накопленные в буфере отложенной записи
+    shutdown_message_buffer()
+    await rag.close()
+    logger.info("Worker shut down")
+
+if __name__ == "__main__":
+    asyncio.run(main())
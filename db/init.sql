@@ -6,15 +6,21 @@ CREATE TABLE IF NOT EXISTS sessions (
     ip_address TEXT
 );
 
+-- messages и async_tasks секционированы по месяцам; секции на текущий и
+-- ближайшие месяцы создает backend (app.db.ensure_partitions), устаревшие
+-- выгружает в архив и удаляет фоновая задача app.retention
 CREATE TABLE IF NOT EXISTS messages (
-    message_id SERIAL PRIMARY KEY,
+    message_id BIGSERIAL,
     session_id UUID REFERENCES sessions(session_id) ON DELETE CASCADE,
     timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     role VARCHAR(10) NOT NULL CHECK (role IN ('user', 'assistant')),
     content TEXT NOT NULL,
     context TEXT,
-    sources TEXT
-);
+    sources TEXT,
+    PRIMARY KEY (message_id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT;
 
 CREATE TABLE IF NOT EXISTS processing_stats (
     stat_id SERIAL PRIMARY KEY,
@@ -25,7 +31,7 @@ CREATE TABLE IF NOT EXISTS processing_stats (
 );
 
 CREATE TABLE IF NOT EXISTS async_tasks (
-    task_id UUID PRIMARY KEY,
+    task_id UUID NOT NULL,
     session_id UUID REFERENCES sessions(session_id) ON DELETE SET NULL,
     created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     started_at TIMESTAMP,
@@ -35,12 +41,70 @@ CREATE TABLE IF NOT EXISTS async_tasks (
     user_id VARCHAR(255),
     question TEXT NOT NULL,
     answer TEXT,
-    error TEXT
+    error TEXT,
+    batch_id UUID,
+    batch_index INTEGER,
+    query_embedding REAL[],
+    worker_id TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    heartbeat_at TIMESTAMP,
+    lease_expires_at TIMESTAMP,
+    tenant VARCHAR(64),
+    PRIMARY KEY (task_id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE IF NOT EXISTS async_tasks_default PARTITION OF async_tasks DEFAULT;
+
+-- Очередь загрузчика: задания на файлы и на отдельные чанки
+CREATE TABLE IF NOT EXISTS ingest_files (
+    file_id BIGSERIAL PRIMARY KEY,
+    filename TEXT NOT NULL,
+    tenant TEXT NOT NULL DEFAULT 'default',
+    fingerprint TEXT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending'
+        CHECK (status IN ('pending', 'chunking', 'embedding', 'completed', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    chunk_count INTEGER,
+    lease_owner TEXT,
+    lease_expires_at TIMESTAMP,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    completed_at TIMESTAMP,
+    UNIQUE (filename, fingerprint)
+);
+
+CREATE TABLE IF NOT EXISTS ingest_chunks (
+    file_id BIGINT NOT NULL REFERENCES ingest_files(file_id) ON DELETE CASCADE,
+    chunk_index INTEGER NOT NULL,
+    text TEXT,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending'
+        CHECK (status IN ('pending', 'processing', 'completed', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires_at TIMESTAMP,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    error TEXT,
+    PRIMARY KEY (file_id, chunk_index)
 );
 
 CREATE INDEX IF NOT EXISTS idx_sessions_created ON sessions(created_at);
-CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id);
+CREATE INDEX IF NOT EXISTS idx_sessions_last_activity ON sessions(last_activity);
+CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, timestamp);
 CREATE INDEX IF NOT EXISTS idx_stats_timestamp ON processing_stats(timestamp);
 CREATE INDEX IF NOT EXISTS idx_async_tasks_user ON async_tasks(user_id);
+CREATE INDEX IF NOT EXISTS idx_async_tasks_session ON async_tasks(session_id);
 CREATE INDEX IF NOT EXISTS idx_async_tasks_status ON async_tasks(status);
-CREATE INDEX IF NOT EXISTS idx_async_tasks_created ON async_tasks(created_at);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS idx_async_tasks_created ON async_tasks(created_at);
+CREATE INDEX IF NOT EXISTS idx_async_tasks_batch ON async_tasks(batch_id);
+CREATE INDEX IF NOT EXISTS idx_async_tasks_pending ON async_tasks(created_at) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_async_tasks_lease ON async_tasks(lease_expires_at) WHERE status = 'processing';
+CREATE INDEX IF NOT EXISTS idx_ingest_files_status ON ingest_files(status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS idx_ingest_chunks_open ON ingest_chunks(status, next_attempt_at) WHERE status IN ('pending', 'processing');
+
+-- Версию схемы записывает backend (app.db.create_tables) при первом запуске,
+-- тогда же создаются помесячные секции
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER PRIMARY KEY,
+    applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
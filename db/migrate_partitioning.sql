@@ -0,0 +1,154 @@
+-- Одноразовая миграция существующей базы на секционированные messages и async_tasks.
+--
+-- Запуск (backend, worker и loader лучше остановить: таблицы блокируются на время копирования):
+--   docker-compose exec -T postgres psql -U raguser -d ragdb -v ON_ERROR_STOP=1 < db/migrate_partitioning.sql
+--
+-- Старая таблица переименовывается в *_legacy, создается секционированная с
+-- помесячными секциями на весь диапазон данных, строки копируются, затем
+-- *_legacy удаляется. Все выполняется в одной транзакции; уже секционированные
+-- таблицы пропускаются, поэтому повторный запуск безопасен.
+
+BEGIN;
+
+DO $$
+DECLARE
+    idx record;
+    cur_month date;
+    last_month date;
+BEGIN
+    IF to_regclass('messages') IS NULL
+       OR EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'messages'::regclass) THEN
+        RAISE NOTICE 'messages: already partitioned, skipped';
+        RETURN;
+    END IF;
+
+    ALTER TABLE messages RENAME TO messages_legacy;
+    -- Имена индексов (включая первичный ключ) уникальны в схеме, освобождаем их
+    FOR idx IN SELECT indexname FROM pg_indexes
+               WHERE schemaname = current_schema() AND tablename = 'messages_legacy' LOOP
+        EXECUTE format('ALTER INDEX %I RENAME TO %I', idx.indexname, idx.indexname || '_legacy');
+    END LOOP;
+    IF to_regclass('messages_message_id_seq') IS NOT NULL THEN
+        ALTER SEQUENCE messages_message_id_seq RENAME TO messages_legacy_message_id_seq;
+    END IF;
+
+    CREATE TABLE messages (
+        message_id BIGSERIAL,
+        session_id UUID REFERENCES sessions(session_id) ON DELETE CASCADE,
+        timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        role VARCHAR(10) NOT NULL CHECK (role IN ('user', 'assistant')),
+        content TEXT NOT NULL,
+        context TEXT,
+        sources TEXT,
+        PRIMARY KEY (message_id, timestamp)
+    ) PARTITION BY RANGE (timestamp);
+    CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+
+    SELECT date_trunc('month', COALESCE(min(timestamp), now()))::date INTO cur_month FROM messages_legacy;
+    last_month := (date_trunc('month', now()) + interval '2 months')::date;
+    WHILE cur_month <= last_month LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+            'messages_p' || to_char(cur_month, 'YYYYMM'), cur_month, (cur_month + interval '1 month')::date
+        );
+        cur_month := (cur_month + interval '1 month')::date;
+    END LOOP;
+
+    INSERT INTO messages (message_id, session_id, timestamp, role, content, context, sources)
+    SELECT message_id, session_id, timestamp, role, content, context, sources FROM messages_legacy;
+    PERFORM setval(
+        pg_get_serial_sequence('messages', 'message_id'),
+        COALESCE((SELECT max(message_id) FROM messages), 0) + 1,
+        false
+    );
+
+    CREATE INDEX idx_messages_session ON messages(session_id, timestamp);
+    DROP TABLE messages_legacy;
+    RAISE NOTICE 'messages: migrated to partitioned table';
+END $$;
+
+DO $$
+DECLARE
+    idx record;
+    cur_month date;
+    last_month date;
+BEGIN
+    IF to_regclass('async_tasks') IS NULL
+       OR EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'async_tasks'::regclass) THEN
+        RAISE NOTICE 'async_tasks: already partitioned, skipped';
+        RETURN;
+    END IF;
+
+    -- Колонки, добавленные после создания старой таблицы
+    ALTER TABLE async_tasks ADD COLUMN IF NOT EXISTS batch_id UUID;
+    ALTER TABLE async_tasks ADD COLUMN IF NOT EXISTS batch_index INTEGER;
+    ALTER TABLE async_tasks ADD COLUMN IF NOT EXISTS query_embedding REAL[];
+    ALTER TABLE async_tasks ADD COLUMN IF NOT EXISTS worker_id TEXT;
+    ALTER TABLE async_tasks ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE async_tasks ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP;
+    ALTER TABLE async_tasks ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP;
+    ALTER TABLE async_tasks ADD COLUMN IF NOT EXISTS tenant VARCHAR(64);
+
+    ALTER TABLE async_tasks RENAME TO async_tasks_legacy;
+    FOR idx IN SELECT indexname FROM pg_indexes
+               WHERE schemaname = current_schema() AND tablename = 'async_tasks_legacy' LOOP
+        EXECUTE format('ALTER INDEX %I RENAME TO %I', idx.indexname, idx.indexname || '_legacy');
+    END LOOP;
+
+    CREATE TABLE async_tasks (
+        task_id UUID NOT NULL,
+        session_id UUID REFERENCES sessions(session_id) ON DELETE SET NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        completed_at TIMESTAMP,
+        status VARCHAR(20) NOT NULL CHECK (status IN ('pending', 'processing', 'completed', 'failed')) DEFAULT 'pending',
+        username VARCHAR(255),
+        user_id VARCHAR(255),
+        question TEXT NOT NULL,
+        answer TEXT,
+        error TEXT,
+        batch_id UUID,
+        batch_index INTEGER,
+        query_embedding REAL[],
+        worker_id TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        heartbeat_at TIMESTAMP,
+        lease_expires_at TIMESTAMP,
+        tenant VARCHAR(64),
+        PRIMARY KEY (task_id, created_at)
+    ) PARTITION BY RANGE (created_at);
+    CREATE TABLE async_tasks_default PARTITION OF async_tasks DEFAULT;
+
+    SELECT date_trunc('month', COALESCE(min(created_at), now()))::date INTO cur_month FROM async_tasks_legacy;
+    last_month := (date_trunc('month', now()) + interval '2 months')::date;
+    WHILE cur_month <= last_month LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF async_tasks FOR VALUES FROM (%L) TO (%L)',
+            'async_tasks_p' || to_char(cur_month, 'YYYYMM'), cur_month, (cur_month + interval '1 month')::date
+        );
+        cur_month := (cur_month + interval '1 month')::date;
+    END LOOP;
+
+    INSERT INTO async_tasks (
+        task_id, session_id, created_at, started_at, completed_at, status, username, user_id,
+        question, answer, error, batch_id, batch_index, query_embedding, worker_id, attempts,
+        heartbeat_at, lease_expires_at, tenant
+    )
+    SELECT
+        task_id, session_id, created_at, started_at, completed_at, status, username, user_id,
+        question, answer, error, batch_id, batch_index, query_embedding, worker_id, attempts,
+        heartbeat_at, lease_expires_at, tenant
+    FROM async_tasks_legacy;
+
+    CREATE INDEX idx_async_tasks_user ON async_tasks(user_id);
+    CREATE INDEX idx_async_tasks_session ON async_tasks(session_id);
+    CREATE INDEX idx_async_tasks_status ON async_tasks(status);
+    CREATE INDEX idx_async_tasks_created ON async_tasks(created_at);
+    CREATE INDEX idx_async_tasks_batch ON async_tasks(batch_id);
+    CREATE INDEX idx_async_tasks_pending ON async_tasks(created_at) WHERE status = 'pending';
+    CREATE INDEX idx_async_tasks_lease ON async_tasks(lease_expires_at) WHERE status = 'processing';
+    DROP TABLE async_tasks_legacy;
+    RAISE NOTICE 'async_tasks: migrated to partitioned table';
+END $$;
+
+COMMIT;
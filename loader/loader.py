@@ -1,4 +1,6 @@
 import os
+import re
+import socket
 import logging
 import shutil
 import hashlib
@@ -6,6 +8,8 @@ import time
 import requests
 import json
 from datetime import datetime
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from qdrant_client import QdrantClient
 from qdrant_client.http import models
 from PyPDF2 import PdfReader
@@ -13,6 +17,7 @@ import docx
 import markdown
 import psycopg2
 from psycopg2 import sql
+from psycopg2.extras import execute_values
 
 # Конфигурация
 SOURCE_DIR = "/app/source"
@@ -30,6 +35,36 @@ POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "ragpassword")
 # Конфигурация Ollama
 OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+# Очередь заданий на загрузку: идентификатор реплики и параметры аренды/повторов
+WORKER_ID = os.getenv("LOADER_WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+LEASE_SECONDS = int(os.getenv("LOADER_LEASE_SECONDS", "300"))
+# Пачка должна вмещать UPLOAD_BATCH_POINTS * UPLOAD_PARALLELISM точек, иначе
+# параллельная загрузка не используется полностью
+CHUNK_CLAIM_BATCH = int(os.getenv("LOADER_CHUNK_BATCH", "256"))
+MAX_ATTEMPTS = int(os.getenv("LOADER_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY = float(os.getenv("LOADER_RETRY_BASE_DELAY", "2"))
+# Через сколько секунд файл, помеченный failed, снова ставится в очередь
+FAILED_RETRY_SECONDS = int(os.getenv("LOADER_FAILED_RETRY_SECONDS", "3600"))
+SCAN_INTERVAL = int(os.getenv("LOADER_SCAN_INTERVAL", "60"))
+
+# Загрузка в Qdrant: транспорт, размеры пачек и параллелизм
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "true").lower() in ("1", "true", "yes")
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
+UPLOAD_BATCH_POINTS = int(os.getenv("UPLOAD_BATCH_POINTS", "64"))
+UPLOAD_BATCH_BYTES = int(os.getenv("UPLOAD_BATCH_BYTES", str(4 * 1024 * 1024)))
+UPLOAD_PARALLELISM = int(os.getenv("UPLOAD_PARALLELISM", "4"))
+UPLOAD_WAIT = os.getenv("UPLOAD_WAIT", "false").lower() in ("1", "true", "yes")
+
+# Разделение по арендаторам: арендатор - подкаталог SOURCE_DIR, файлы в корне
+# принадлежат DEFAULT_TENANT. TENANT_MODE=payload хранит всех в одной коллекции
+# с индексированным полем tenant, TENANT_MODE=collection - в отдельных коллекциях
+TENANT_MODE = os.getenv("TENANT_MODE", "payload")
+DEFAULT_TENANT = os.getenv("DEFAULT_TENANT", "default")
+
+class TransientError(Exception):
+    """Временная ошибка внешнего сервиса, операцию можно повторить"""
 
 def setup_logging():
     os.makedirs(LOG_DIR, exist_ok=True)
@@ -54,29 +89,56 @@ def wait_for_service(url, service_name):
         logger.info(f"Waiting for {service_name} to start...")
         time.sleep(5)
 
+def tenant_name(directory: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_-]", "_", directory)[:64]
+
+def collection_for(collection_name: str, tenant: str) -> str:
+    """Коллекция арендатора; DEFAULT_TENANT остается в базовой коллекции"""
+    if TENANT_MODE != "collection" or tenant == DEFAULT_TENANT:
+        return collection_name
+    return f"{collection_name}_{tenant}"
+
+_known_collections = set()
+
+def ensure_collection(client, collection_name: str):
+    if collection_name in _known_collections:
+        return
+    if not client.collection_exists(collection_name):
+        # Получаем размерность эмбеддингов
+        embedding_size = get_embedding_size()
+        if not embedding_size:
+            raise ValueError("Failed to get embedding dimension")
+            
+        client.create_collection(
+            collection_name=collection_name,
+            vectors_config=models.VectorParams(
+                size=embedding_size,
+                distance=models.Distance.COSINE
+            )
+        )
+        logger.info(f"Created collection: {collection_name} with dim={embedding_size}")
+
+    if TENANT_MODE == "payload":
+        # is_tenant группирует точки арендатора на диске и ускоряет фильтрованный поиск
+        client.create_payload_index(
+            collection_name=collection_name,
+            field_name="tenant",
+            field_schema=models.KeywordIndexParams(type="keyword", is_tenant=True)
+        )
+    _known_collections.add(collection_name)
+
 def init_qdrant():
     client = QdrantClient(
         url=os.getenv("QDRANT_URL", "http://qdrant:6333"),
-        api_key=os.getenv("QDRANT_API_KEY")
+        api_key=os.getenv("QDRANT_API_KEY"),
+        prefer_grpc=QDRANT_PREFER_GRPC,
+        grpc_port=QDRANT_GRPC_PORT
     )
     
     collection_name = os.getenv("COLLECTION_NAME", "documents")
     
     try:
-        if not client.collection_exists(collection_name):
-            # Получаем размерность эмбеддингов
-            embedding_size = get_embedding_size()
-            if not embedding_size:
-                raise ValueError("Failed to get embedding dimension")
-                
-            client.create_collection(
-                collection_name=collection_name,
-                vectors_config=models.VectorParams(
-                    size=embedding_size,
-                    distance=models.Distance.COSINE
-                )
-            )
-            logger.info(f"Created collection: {collection_name} with dim={embedding_size}")
+        ensure_collection(client, collection_name)
     except Exception as e:
         logger.error(f"Qdrant connection error: {str(e)}")
         raise
@@ -106,6 +168,19 @@ def get_embedding_size():
         logger.error(f"Error getting embedding size: {str(e)}")
         return 768  # Значение по умолчанию
 
+def with_retries(operation, description: str, attempts: int = 3):
+    """Повторяет операцию с экспоненциальной задержкой; после последней попытки
+    пробрасывает TransientError"""
+    for attempt in range(attempts):
+        try:
+            return operation()
+        except Exception as e:
+            if attempt == attempts - 1:
+                raise TransientError(f"{description}: {str(e)}") from e
+            delay = RETRY_BASE_DELAY * 2 ** attempt
+            logger.warning(f"{description} failed ({str(e)}), retry in {delay:.0f}s")
+            time.sleep(delay)
+
 def get_embedding(text: str) -> list:
     """Получение эмбеддинга из Ollama"""
     try:
@@ -113,7 +188,8 @@ def get_embedding(text: str) -> list:
             f"{OLLAMA_HOST}/api/embeddings",
             json={
                 "model": EMBEDDING_MODEL,
-                "prompt": text
+                "prompt": text,
+                "keep_alive": OLLAMA_KEEP_ALIVE
             },
             timeout=30.0
         )
@@ -167,103 +243,532 @@ def chunk_text(text):
     
     return chunks
 
-def save_processing_stats(processed_files: int, processed_vectors: int, errors: int):
+@contextmanager
+def get_db_cursor():
+    conn = psycopg2.connect(
+        host=POSTGRES_HOST,
+        database=POSTGRES_DB,
+        user=POSTGRES_USER,
+        password=POSTGRES_PASSWORD
+    )
     try:
-        conn = psycopg2.connect(
-            host=POSTGRES_HOST,
-            database=POSTGRES_DB,
-            user=POSTGRES_USER,
-            password=POSTGRES_PASSWORD
-        )
         cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO processing_stats (processed_files, processed_vectors, errors) VALUES (%s, %s, %s)",
-            (processed_files, processed_vectors, errors)
-        )
-        conn.commit()
+        try:
+            yield cursor
+            conn.commit()
+        finally:
+            cursor.close()
+    finally:
+        conn.close()
+
+def save_processing_stats(processed_files: int, processed_vectors: int, errors: int):
+    try:
+        with get_db_cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO processing_stats (processed_files, processed_vectors, errors) VALUES (%s, %s, %s)",
+                (processed_files, processed_vectors, errors)
+            )
         logger.info(f"Saved stats: files={processed_files}, vectors={processed_vectors}, errors={errors}")
     except Exception as e:
         logger.error(f"Error saving stats: {str(e)}")
-    finally:
-        if conn:
-            conn.close()
 
-def process_files(qdrant_client, collection_name):
-    processed_files = []
-    total_vectors = 0
-    error_count = 0
-    
-    for file_name in os.listdir(SOURCE_DIR):
+def init_job_tables():
+    with get_db_cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ingest_files (
+                file_id BIGSERIAL PRIMARY KEY,
+                filename TEXT NOT NULL,
+                tenant TEXT NOT NULL DEFAULT 'default',
+                fingerprint TEXT NOT NULL,
+                status VARCHAR(20) NOT NULL DEFAULT 'pending'
+                    CHECK (status IN ('pending', 'chunking', 'embedding', 'completed', 'failed')),
+                attempts INTEGER NOT NULL DEFAULT 0,
+                chunk_count INTEGER,
+                lease_owner TEXT,
+                lease_expires_at TIMESTAMP,
+                next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                error TEXT,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                completed_at TIMESTAMP,
+                UNIQUE (filename, fingerprint)
+            );
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ingest_chunks (
+                file_id BIGINT NOT NULL REFERENCES ingest_files(file_id) ON DELETE CASCADE,
+                chunk_index INTEGER NOT NULL,
+                text TEXT,
+                status VARCHAR(20) NOT NULL DEFAULT 'pending'
+                    CHECK (status IN ('pending', 'processing', 'completed', 'failed')),
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires_at TIMESTAMP,
+                next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                error TEXT,
+                PRIMARY KEY (file_id, chunk_index)
+            );
+        """)
+        cursor.execute("ALTER TABLE ingest_files ADD COLUMN IF NOT EXISTS tenant TEXT NOT NULL DEFAULT 'default'")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_ingest_files_status ON ingest_files(status, next_attempt_at)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_ingest_chunks_open ON ingest_chunks(status, next_attempt_at) "
+            "WHERE status IN ('pending', 'processing')"
+        )
+
+def file_fingerprint(file_path: str) -> str:
+    stat = os.stat(file_path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+def source_files():
+    """Файлы SOURCE_DIR и его подкаталогов первого уровня: (путь относительно SOURCE_DIR, арендатор)"""
+    for entry in os.scandir(SOURCE_DIR):
+        if entry.is_file():
+            yield entry.name, DEFAULT_TENANT
+        elif entry.is_dir():
+            tenant = tenant_name(entry.name)
+            for sub_entry in os.scandir(entry.path):
+                if sub_entry.is_file():
+                    yield os.path.join(entry.name, sub_entry.name), tenant
+
+def register_files() -> int:
+    """Регистрирует новые файлы из SOURCE_DIR; повторная регистрация игнорируется,
+    поэтому сканировать каталог могут все реплики одновременно"""
+    rows = []
+    for file_name, tenant in source_files():
         file_path = os.path.join(SOURCE_DIR, file_name)
-        if not os.path.isfile(file_path):
-            continue
         
         ext = os.path.splitext(file_name)[1].lower()
         if ext not in SUPPORTED_EXT:
             logger.warning(f"Unsupported format: {file_name}")
             continue
-        
-        logger.info(f"Processing: {file_name}")
-        text = extract_text(file_path)
-        if not text:
-            error_count += 1
-            continue
-        
-        chunks = chunk_text(text)
-        logger.info(f"Created {len(chunks)} chunks")
-        
-        if not chunks:
-            error_count += 1
+
+        try:
+            rows.append((file_name, tenant, file_fingerprint(file_path)))
+        except FileNotFoundError:
+            # Файл уже перемещен другой репликой
             continue
-        
-        # Получаем эмбеддинги для всех чанков
-        embeddings = []
-        for chunk in chunks:
-            embedding = get_embedding(chunk)
-            if embedding:
-                embeddings.append(embedding)
-            else:
-                logger.warning(f"Failed to get embedding for chunk: {chunk[:50]}...")
-        
-        if not embeddings:
-            logger.error(f"No embeddings generated for {file_name}")
-            error_count += 1
+
+    if not rows:
+        return 0
+
+    with get_db_cursor() as cursor:
+        # Файл, упавший с ошибкой, после паузы FAILED_RETRY_SECONDS обрабатывается заново
+        execute_values(
+            cursor,
+            sql.SQL("""
+                INSERT INTO ingest_files (filename, tenant, fingerprint) VALUES %s
+                ON CONFLICT (filename, fingerprint) DO UPDATE
+                SET status = 'pending', attempts = 0, error = NULL, completed_at = NULL,
+                    next_attempt_at = CURRENT_TIMESTAMP
+                WHERE ingest_files.status = 'failed'
+                  AND COALESCE(ingest_files.completed_at, ingest_files.next_attempt_at)
+                      < CURRENT_TIMESTAMP - make_interval(secs => {})
+                RETURNING file_id, xmax = 0
+            """).format(sql.Literal(FAILED_RETRY_SECONDS)),
+            rows,
+            page_size=len(rows)
+        )
+        result = cursor.fetchall()
+        retried = [file_id for file_id, inserted in result if not inserted]
+        if retried:
+            # Успешные чанки сохраняются, упавшие получают новые попытки
+            cursor.execute(
+                """
+                UPDATE ingest_chunks
+                SET status = 'pending', attempts = 0, error = NULL, next_attempt_at = CURRENT_TIMESTAMP
+                WHERE file_id = ANY(%s) AND status = 'failed'
+                """,
+                (retried,)
+            )
+    registered = len(result) - len(retried)
+    if registered:
+        logger.info(f"Registered {registered} new files")
+    if retried:
+        logger.info(f"Requeued {len(retried)} failed files")
+    return registered
+
+def retry_delay(attempts: int) -> float:
+    return RETRY_BASE_DELAY * 2 ** attempts
+
+def claim_file_job() -> dict|None:
+    """Берет в аренду файл, ожидающий разбиения на чанки (или с истекшей арендой)"""
+    with get_db_cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE ingest_files
+            SET status = 'chunking', attempts = attempts + 1, lease_owner = %s,
+                lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+            WHERE file_id = (
+                SELECT file_id
+                FROM ingest_files
+                WHERE (status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP)
+                   OR (status = 'chunking' AND lease_expires_at < CURRENT_TIMESTAMP)
+                ORDER BY file_id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING file_id, filename, attempts
+            """,
+            (WORKER_ID, LEASE_SECONDS)
+        )
+        job = cursor.fetchone()
+        return {"file_id": job[0], "filename": job[1], "attempts": job[2]} if job else None
+
+def fail_file_job(job: dict, error: str):
+    """Возвращает файл в очередь с задержкой или помечает как ошибочный"""
+    final = job["attempts"] >= MAX_ATTEMPTS
+    with get_db_cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE ingest_files
+            SET status = %s, error = %s, lease_owner = NULL, lease_expires_at = NULL,
+                next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+            WHERE file_id = %s AND lease_owner = %s
+            """,
+            ('failed' if final else 'pending', error, retry_delay(job["attempts"]), job["file_id"], WORKER_ID)
+        )
+    logger.error(f"File {job['filename']} {'failed' if final else 'requeued'}: {error}")
+
+def chunk_file_job(job: dict) -> bool:
+    """Разбивает файл на чанки и ставит по заданию на каждый чанк"""
+    file_path = os.path.join(SOURCE_DIR, job["filename"])
+    logger.info(f"Processing: {job['filename']}")
+    text = extract_text(file_path)
+    chunks = chunk_text(text)
+    logger.info(f"Created {len(chunks)} chunks")
+    if not chunks:
+        fail_file_job(job, "No text extracted")
+        return False
+
+    with get_db_cursor() as cursor:
+        # Чанки от прерванной попытки остаются: ON CONFLICT сохраняет их прогресс
+        execute_values(
+            cursor,
+            "INSERT INTO ingest_chunks (file_id, chunk_index, text) VALUES %s ON CONFLICT DO NOTHING",
+            [(job["file_id"], idx, chunk) for idx, chunk in enumerate(chunks)],
+            page_size=1000
+        )
+        cursor.execute(
+            """
+            UPDATE ingest_files
+            SET status = 'embedding', chunk_count = %s, lease_owner = NULL, lease_expires_at = NULL
+            WHERE file_id = %s AND lease_owner = %s
+            """,
+            (len(chunks), job["file_id"], WORKER_ID)
+        )
+    return True
+
+def claim_chunk_jobs() -> list[dict]:
+    """Берет в аренду пачку чанков, ожидающих эмбеддинга и загрузки"""
+    with get_db_cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE ingest_chunks c
+            SET status = 'processing', attempts = c.attempts + 1, lease_owner = %s,
+                lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+            FROM ingest_files f
+            WHERE f.file_id = c.file_id
+              AND (c.file_id, c.chunk_index) IN (
+                SELECT file_id, chunk_index
+                FROM ingest_chunks
+                WHERE (status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP)
+                   OR (status = 'processing' AND lease_expires_at < CURRENT_TIMESTAMP)
+                ORDER BY file_id, chunk_index
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+              )
+            RETURNING c.file_id, c.chunk_index, c.text, c.attempts, f.filename, f.tenant
+            """,
+            (WORKER_ID, LEASE_SECONDS, CHUNK_CLAIM_BATCH)
+        )
+        return [
+            {"file_id": row[0], "chunk_index": row[1], "text": row[2], "attempts": row[3],
+             "filename": row[4], "tenant": row[5]}
+            for row in sorted(cursor.fetchall(), key=lambda row: (row[0], row[1]))
+        ]
+
+def complete_chunk_jobs(jobs: list[dict]):
+    with get_db_cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE ingest_chunks
+            SET status = 'completed', text = NULL, error = NULL, lease_owner = NULL, lease_expires_at = NULL
+            WHERE (file_id, chunk_index) IN (SELECT * FROM unnest(%s::bigint[], %s::integer[]))
+              AND lease_owner = %s
+            """,
+            ([job["file_id"] for job in jobs], [job["chunk_index"] for job in jobs], WORKER_ID)
+        )
+
+def extend_chunk_leases(jobs: list[dict]):
+    """Продлевает аренду чанков, пока пачка еще обрабатывается"""
+    with get_db_cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE ingest_chunks
+            SET lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+            WHERE (file_id, chunk_index) IN (SELECT * FROM unnest(%s::bigint[], %s::integer[]))
+              AND lease_owner = %s AND status = 'processing'
+            """,
+            (LEASE_SECONDS, [job["file_id"] for job in jobs], [job["chunk_index"] for job in jobs], WORKER_ID)
+        )
+
+def release_chunk_jobs(jobs: list[dict], delay: float):
+    """Возвращает необработанные чанки в очередь, не расходуя их попытки"""
+    if not jobs:
+        return
+    with get_db_cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE ingest_chunks
+            SET status = 'pending', attempts = GREATEST(attempts - 1, 0), lease_owner = NULL,
+                lease_expires_at = NULL, next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+            WHERE (file_id, chunk_index) IN (SELECT * FROM unnest(%s::bigint[], %s::integer[]))
+              AND lease_owner = %s
+            """,
+            (delay, [job["file_id"] for job in jobs], [job["chunk_index"] for job in jobs], WORKER_ID)
+        )
+    logger.warning(f"Released {len(jobs)} chunks back to the queue")
+
+def fail_chunk_jobs(jobs: list[dict], error: str):
+    with get_db_cursor() as cursor:
+        for job in jobs:
+            final = job["attempts"] >= MAX_ATTEMPTS
+            cursor.execute(
+                """
+                UPDATE ingest_chunks
+                SET status = %s, error = %s, lease_owner = NULL, lease_expires_at = NULL,
+                    next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                WHERE file_id = %s AND chunk_index = %s AND lease_owner = %s
+                """,
+                ('failed' if final else 'pending', error, retry_delay(job["attempts"]),
+                 job["file_id"], job["chunk_index"], WORKER_ID)
+            )
+    logger.error(f"{len(jobs)} chunks of {jobs[0]['filename']} requeued or failed: {error}")
+
+def build_point(job: dict, embedding: list) -> models.PointStruct:
+    return models.PointStruct(
+        id=hashlib.md5(f"{job['filename']}_{job['chunk_index']}".encode()).hexdigest(),
+        vector=embedding,
+        payload={
+            "filename": job["filename"],
+            "tenant": job["tenant"],
+            "chunk_index": job["chunk_index"],
+            "text": job["text"],
+            "processed": datetime.now().isoformat()
+        }
+    )
+
+def embed_chunk(text: str) -> list:
+    def operation():
+        embedding = get_embedding(text)
+        if not embedding:
+            raise ValueError("empty embedding")
+        return embedding
+    return with_retries(operation, "Ollama embedding")
+
+def point_size(point: models.PointStruct) -> int:
+    """Оценка размера точки в запросе: float32 на компоненту плюс payload"""
+    return len(point.vector) * 4 + len(json.dumps(point.payload, ensure_ascii=False).encode())
+
+def split_points(points: list) -> list[list]:
+    """Делит точки на пачки, ограниченные числом точек и размером запроса"""
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for point in points:
+        size = point_size(point)
+        if batch and (len(batch) >= UPLOAD_BATCH_POINTS or batch_bytes + size > UPLOAD_BATCH_BYTES):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(point)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+_collection_shards = {}
+
+def shard_count(qdrant_client, collection_name: str) -> int:
+    if collection_name not in _collection_shards:
+        params = qdrant_client.get_collection(collection_name).config.params
+        _collection_shards[collection_name] = params.shard_number or 1
+    return _collection_shards[collection_name]
+
+def upload_points(qdrant_client, collection_name, points: list):
+    """Параллельная загрузка пачками.
+
+    При UPLOAD_WAIT=false пачки подтверждаются после записи в WAL, а в конце
+    выполняется барьер: повторная запись первой точки каждой пачки с wait=True.
+    Операции применяются в порядке WAL одного шарда, поэтому барьер покрывает
+    предыдущие пачки только в односегментной коллекции; для коллекций из
+    нескольких шардов каждая пачка записывается с wait=True.
+    """
+    batches = split_points(points)
+    wait = UPLOAD_WAIT or shard_count(qdrant_client, collection_name) > 1
+
+    def upload(numbered):
+        number, batch = numbered
+        started = time.monotonic()
+        with_retries(
+            lambda: qdrant_client.upsert(collection_name=collection_name, points=batch, wait=wait),
+            "Qdrant upsert"
+        )
+        elapsed = time.monotonic() - started
+        logger.info(
+            f"Upload batch {number + 1}/{len(batches)}: {len(batch)} points, "
+            f"{sum(point_size(point) for point in batch)} bytes, {elapsed * 1000:.0f} ms"
+        )
+        return elapsed
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=UPLOAD_PARALLELISM) as executor:
+        timings = list(executor.map(upload, enumerate(batches)))
+
+    if not wait:
+        barrier = [batch[0] for batch in batches]
+        with_retries(
+            lambda: qdrant_client.upsert(collection_name=collection_name, points=barrier, wait=True),
+            "Qdrant consistency barrier"
+        )
+
+    logger.info(
+        f"Uploaded {len(points)} points in {len(batches)} batches, "
+        f"{(time.monotonic() - started) * 1000:.0f} ms total, "
+        f"max batch {max(timings) * 1000:.0f} ms"
+    )
+
+def process_chunk_jobs(qdrant_client, collection_name, jobs: list[dict]) -> tuple[int, bool]:
+    """Эмбеддинг и загрузка пачки чанков.
+
+    Возвращает число загруженных векторов и признак того, что пачка прервана
+    из-за недоступности Ollama: остальные чанки возвращены в очередь без
+    расхода попыток, и проход по очереди стоит отложить.
+    """
+    by_collection = {}
+    interrupted = False
+    renewed_at = time.monotonic()
+    for position, job in enumerate(jobs):
+        # Пачка может обрабатываться дольше аренды, если Ollama отвечает медленно
+        if time.monotonic() - renewed_at >= LEASE_SECONDS / 3:
+            extend_chunk_leases(jobs)
+            renewed_at = time.monotonic()
+        try:
+            point = build_point(job, embed_chunk(job["text"]))
+        except TransientError as e:
+            # Попытка расходуется только на текущий чанк, остальные ждут восстановления сервиса
+            fail_chunk_jobs([job], str(e))
+            release_chunk_jobs(jobs[position + 1:], retry_delay(job["attempts"]))
+            interrupted = True
+            break
+        except Exception as e:
+            fail_chunk_jobs([job], str(e))
             continue
-        
-        # Подготовка точек для Qdrant
-        points = []
-        for idx, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-            points.append(models.PointStruct(
-                id=hashlib.md5(f"{file_name}_{idx}".encode()).hexdigest(),
-                vector=embedding,
-                payload={
-                    "filename": file_name,
-                    "chunk_index": idx,
-                    "text": chunk,
-                    "processed": datetime.now().isoformat()
-                }
-            ))
-        
+        target = by_collection.setdefault(collection_for(collection_name, job["tenant"]), ([], []))
+        target[0].append(job)
+        target[1].append(point)
+
+    if by_collection and time.monotonic() - renewed_at >= LEASE_SECONDS / 3:
+        extend_chunk_leases([job for embedded, _ in by_collection.values() for job in embedded])
+
+    uploaded = 0
+    for target_collection, (embedded, points) in by_collection.items():
         try:
-            # Загрузка в Qdrant
-            qdrant_client.upsert(
-                collection_name=collection_name,
-                points=points,
-                wait=True
-            )
-            logger.info(f"Uploaded {len(points)} vectors")
-            
-            # Перемещаем обработанный файл
-            new_path = os.path.join(PROCESSED_DIR, file_name)
-            shutil.move(file_path, new_path)
-            processed_files.append(file_name)
-            total_vectors += len(points)
+            ensure_collection(qdrant_client, target_collection)
+            upload_points(qdrant_client, target_collection, points)
         except Exception as e:
-            logger.error(f"Upload error: {str(e)}")
-            error_count += 1
-    
+            fail_chunk_jobs(embedded, str(e))
+            continue
+
+        # Чанки отмечаются завершенными только после барьера согласованности
+        complete_chunk_jobs(embedded)
+        uploaded += len(points)
+    return uploaded, interrupted
+
+def finalize_files() -> tuple[list[str], int]:
+    """Закрывает файлы, у которых не осталось незавершенных чанков.
+
+    Возвращает имена загруженных файлов и число файлов с ошибками.
+    """
+    with get_db_cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE ingest_files f
+            SET status = CASE
+                    WHEN EXISTS (SELECT 1 FROM ingest_chunks c WHERE c.file_id = f.file_id AND c.status = 'failed')
+                    THEN 'failed' ELSE 'completed' END,
+                completed_at = CURRENT_TIMESTAMP
+            WHERE f.file_id IN (
+                SELECT file_id FROM ingest_files
+                WHERE status = 'embedding'
+                  AND NOT EXISTS (
+                    SELECT 1 FROM ingest_chunks c
+                    WHERE c.file_id = ingest_files.file_id AND c.status IN ('pending', 'processing')
+                  )
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING f.filename, f.status
+            """
+        )
+        finished = cursor.fetchall()
+
+    completed = []
+    errors = 0
+    for file_name, status in finished:
+        if status != 'completed':
+            logger.error(f"File {file_name} has failed chunks")
+            errors += 1
+            continue
+        # Перемещаем обработанный файл, сохраняя подкаталог арендатора
+        new_path = os.path.join(PROCESSED_DIR, file_name)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        try:
+            shutil.move(os.path.join(SOURCE_DIR, file_name), new_path)
+        except FileNotFoundError:
+            logger.warning(f"File {file_name} already moved")
+        completed.append(file_name)
+    return completed, errors
+
+def process_files(qdrant_client, collection_name):
+    """Один проход по очереди: регистрация, разбиение и загрузка до исчерпания работы"""
+    processed_files = []
+    total_vectors = 0
+    error_count = 0
+
+    register_files()
+
+    while True:
+        job = claim_file_job()
+        if job:
+            try:
+                if not chunk_file_job(job):
+                    error_count += 1
+            except Exception as e:
+                fail_file_job(job, str(e))
+                error_count += 1
+            continue
+
+        chunk_jobs = claim_chunk_jobs()
+        if not chunk_jobs:
+            break
+        uploaded, interrupted = process_chunk_jobs(qdrant_client, collection_name, chunk_jobs)
+        total_vectors += uploaded
+
+        completed, errors = finalize_files()
+        processed_files.extend(completed)
+        error_count += errors
+        if interrupted:
+            logger.warning("Embedding service unavailable, remaining chunks postponed to the next scan")
+            break
+
+    completed, errors = finalize_files()
+    processed_files.extend(completed)
+    error_count += errors
+
     # Сохраняем статистику
-    if processed_files or error_count:
+    if processed_files or total_vectors or error_count:
         save_processing_stats(len(processed_files), total_vectors, error_count)
     
     return processed_files
@@ -282,13 +787,30 @@ def main():
     wait_for_service(f"{os.getenv('QDRANT_URL', 'http://qdrant:6333')}/readyz", "Qdrant")
     
     qdrant_client, collection_name = init_qdrant()
+    init_job_tables()
+
+    # Загружаем модель эмбеддингов заранее, чтобы первый файл не ждал ее загрузки
+    try:
+        embed_chunk("warm-up")
+        logger.info("Embedding model warmed up")
+    except TransientError as e:
+        logger.warning(f"Embedding warm-up failed: {str(e)}")
+    logger.info(f"Loader worker id: {WORKER_ID}")
+    if CHUNK_CLAIM_BATCH < UPLOAD_BATCH_POINTS * UPLOAD_PARALLELISM:
+        logger.warning(
+            f"LOADER_CHUNK_BATCH={CHUNK_CLAIM_BATCH} is below UPLOAD_BATCH_POINTS * UPLOAD_PARALLELISM "
+            f"({UPLOAD_BATCH_POINTS * UPLOAD_PARALLELISM}), uploads will not use full parallelism"
+        )
     
     while True:
         logger.info("Starting scan cycle...")
-        processed = process_files(qdrant_client, collection_name)
-        if processed:
-            logger.info(f"Processed files: {', '.join(processed)}")
-        time.sleep(60)
+        try:
+            processed = process_files(qdrant_client, collection_name)
+            if processed:
+                logger.info(f"Processed files: {', '.join(processed)}")
+        except Exception as e:
+            logger.error(f"Scan cycle error: {str(e)}")
+        time.sleep(SCAN_INTERVAL)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file